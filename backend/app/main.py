@@ -1,12 +1,32 @@
 # backend/app/main.py
 import os
 import google.generativeai as genai
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from pydantic import BaseModel
+from typing import Literal
 from dotenv import load_dotenv
-import datetime
+import codecs
 import services.weather as weather
+import services.scheduler as scheduler
+import services.snapshot as snapshot
+import services.serialization as serialization
+import services.profiler as profiler
+import services.assets as assets
+import services.weekly_plan as weekly_plan
+import services.structured_advice as structured_advice
+import services.wardrobe as wardrobe
+import services.digest as digest
+import services.forecast_cache as forecast_cache
+import services.push as push
+import services.model_router as model_router
+import services.health as health
+import services.prompts as prompts
+import services.jobs as jobs
+import services.admission as admission
 
 # .envファイルをコンテナ内で読み込む場合 (Composeで環境変数として渡す方が一般的)
 # load_dotenv() # Docker Composeのenv_fileを使うので通常不要
@@ -14,17 +34,26 @@ import services.weather as weather
 # 環境変数からAPIキーを取得
 api_key = os.getenv("GOOGLE_API_KEY")
 
+# 設定に問題があってもプロセスは起動し、/health/ready で準備ができていないことを返す
+gemini_configured = False
 if not api_key:
     print("Error: GOOGLE_API_KEY environment variable not set.")
-    exit() # APIキーがない場合は起動しない
+    health.record("gemini_config", False, "GOOGLE_API_KEY environment variable not set")
+else:
+    try:
+        genai.configure(api_key=api_key)
+        gemini_configured = True
+        health.record("gemini_config", True)
+    except Exception as e:
+        print(f"Error configuring Gemini API: {e}")
+        health.record("gemini_config", False, f"Error configuring Gemini API: {e}")
 
-try:
-    genai.configure(api_key=api_key)
-except Exception as e:
-    print(f"Error configuring Gemini API: {e}")
-    exit()
+# orjsonがあれば高速なJSONエンコーダを既定にする
+app = FastAPI(title="Gemini API Backend", default_response_class=serialization.FastJSONResponse)
 
-app = FastAPI(title="Gemini API Backend")
+# 高価なエンドポイントの同時実行数を制限し、処理しきれないリクエストはすぐに 503 で断る
+# (最初に追加したミドルウェアが最も内側になるので、503 にもCORSヘッダが付く)
+app.add_middleware(admission.AdmissionMiddleware)
 
 # CORS設定
 # Docker環境では、Fletアプリ(ブラウザ)からのアクセス元(localhost:フロントエンドポート)を許可
@@ -47,164 +76,627 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 一定サイズ以上のレスポンスを圧縮する (brotli-asgiがあればbr、なければgzip)。
+# /static のアイコン・フォントは圧縮済みの形式なので対象外にする
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
 try:
-    model = genai.GenerativeModel('gemini-2.0-flash-lite') # 必要ならモデル名変更
-except Exception as e:
-    print(f"Error creating Gemini model: {e}")
-    exit()
+    from brotli_asgi import BrotliMiddleware
+    app.add_middleware(assets.UncompressedStaticMiddleware, compressor=BrotliMiddleware, minimum_size=COMPRESSION_MIN_SIZE, gzip_fallback=True)
+except ImportError:
+    app.add_middleware(assets.UncompressedStaticMiddleware, compressor=GZipMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
+
+# X-Profile ヘッダ (または PROFILE_ALL=1) でリクエストをプロファイルする
+app.add_middleware(profiler.ProfilingMiddleware)
+
+def generate_with_gemini(prompt, snapshot_key, generation_config=None, quick=False, min_output_tokens=None, system_instruction=None):
+    """
+    Geminiでテキストを生成する。
+    モデルと出力トークン数の上限は、混雑状況と quick に応じて model_router が選ぶ (GEMINI_MODELS で変更)。
+    system_instruction (テンプレートの固定の指示) はモデル側に保持し、prompt には可変部分だけを渡す。
+    replayモードでは記録済みの出力を返し、SNAPSHOT_RECORD_GEMINI=1 なら出力を記録する。
+    """
+    if snapshot.is_replay():
+        recorded = snapshot.latest("gemini", snapshot_key)
+        if recorded is None:
+            raise HTTPException(status_code=404, detail=f"No recorded Gemini output for {snapshot_key}")
+        return recorded["text"]
+
+    if not gemini_configured:
+        raise HTTPException(status_code=503, detail="Gemini API is not configured")
+
+    route = model_router.choose(quick=quick, min_output_tokens=min_output_tokens)
+    response = model_router.generate(route, prompt + model_router.brevity_instruction(route), generation_config, system_instruction)
+
+    if hasattr(response, 'text'):
+        generated_text = response.text
+    elif response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+        generated_text = "".join(part.text for part in response.candidates[0].content.parts)
+    else:
+        print(f"Unexpected Gemini API response format: {response}")
+        raise HTTPException(status_code=500, detail="Failed to parse Gemini API response")
+
+    snapshot.record("gemini", snapshot_key, {"system_instruction": system_instruction, "prompt": prompt, "text": generated_text})
+    return generated_text
+
+# 服装提案の形式 ("text": Markdownのテキスト / "structured": 構造化された提案)。
+# リクエストのモデルとクエリパラメータの型に使い、不正な値は FastAPI (pydantic) が 422 で断る
+AdviceFormat = Literal["text", "structured"]
+# 服一覧のインポート・エクスポートの形式
+WardrobeFormat = Literal["csv", "jsonl"]
 
 class Prefecture_city(BaseModel):
     name: str
+    format: AdviceFormat = "text"
+    quick: bool = False   # 短く速い回答を優先する
       
 class Clothes(BaseModel):
     name: str
+    category: str | None = None  # wardrobe.CATEGORIES のいずれか
 
 class ClothesToDelete(BaseModel):
     name: str
 
+class AdviceBasis(BaseModel):
+    name: str
+    format: AdviceFormat = "text"
+    profile: list              # /generate のレスポンスの basis.profile
+    wardrobe_version: str      # /generate のレスポンスの basis.wardrobe_version
+
+def parse_location(name):
+    """
+    "県名_市名" 形式の文字列を (県名, 市名) に分割する
+    """
+    parts = name.split('_')
+    if len(parts) != 2:
+        raise HTTPException(status_code=400, detail="Invalid format. Expected 'prefecture_city'")
+    return parts[0], parts[1]
+
+def read_clothes_items():
+    """
+    clothes_list.txtから服装リストを取得する
+    """
+    try:
+        return wardrobe.load_items()
+    except Exception as e:
+        print(f"Error reading clothes_list.txt: {e}")
+        # ファイルが読めなくてもエラーにはしない
+        return []
+
+def wardrobe_version():
+    """
+    服装リストの内容を表すハッシュ (作成済みの提案が古くなっていないかの確認に使う)
+    """
+    return wardrobe.version(read_clothes_items())
+
+def select_clothes(items, forecasts):
+    """
+    予報の体感温度と降水確率に合う服を、カテゴリごとに上位の数件だけ選ぶ
+    """
+    feels_like_values = [forecast["feels_like"] for forecast in forecasts if "feels_like" in forecast]
+    max_pop = max((forecast.get("prob_precipitation", 0) for forecast in forecasts), default=0)
+    return wardrobe.preselect(items, feels_like_values, max_pop)
+
+def fetch_weather(prefecture, city, priority=scheduler.PRIORITY_INTERACTIVE):
+    """
+    県名と市名から天気予報を取得する
+    """
+    # 天気情報を取得
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+    if not api_key and not snapshot.is_replay():
+        raise HTTPException(status_code=500, detail="OpenWeather API key not found")
+    
+    # 緯度経度の取得
+    coordinates = weather.get_lat_lon(prefecture, city, priority=priority)
+    if not coordinates:
+        raise HTTPException(status_code=404, detail=f"Location {prefecture}{city} not found")
+    
+    latitude, longitude = coordinates
+    weather_data = weather.get_weather_forecast_by_coords(latitude, longitude, api_key, priority=priority)
+    
+    if not weather_data:
+        raise HTTPException(status_code=500, detail="Failed to get weather forecast")
+    return weather_data
+
+def upstream_unavailable(e):
+    """
+    外部APIのレート制限・クォータ超過を 503 (Retry-After 付き) に変換する
+    """
+    if isinstance(e, scheduler.QuotaExceededError):
+        print(f"Upstream quota exceeded: {e}")
+        return HTTPException(status_code=503, detail="外部APIの本日の利用上限に達しました", headers={"Retry-After": "3600"})
+    print(f"Upstream busy: {e}")
+    return HTTPException(status_code=503, detail="外部APIが混雑しています。しばらくしてから再度お試しください", headers={"Retry-After": "5"})
+
+def extract_today(weather_data, now):
+    """
+    天気情報から今日の予報を抽出する
+    """
+    today_str = now.strftime("%Y-%m-%d")
+    today_forecasts = []
+    for forecast in weather_data.get("forecasts", []):
+        forecast_time = forecast.get("datetime", "")
+        if today_str in forecast_time:
+            today_forecasts.append(forecast)
+    return today_forecasts
+
+def summarize_today(today_forecasts):
+    """
+    今日の予報からプロンプト用の要約を作成する
+    """
+    weather_summary = "本日の天気情報:\n"
+    for forecast in today_forecasts:
+        time = forecast.get("datetime", "").split(" ")[1][:3]  # "HH時"のみ取得
+        desc = forecast.get("weather", {}).get("description", "不明")
+        temp = forecast.get("temperature", "不明")
+        feels_like = forecast.get("feels_like", "不明")
+        prob_precipitation = forecast.get("prob_precipitation", 0) * 100  # 確率をパーセントに変換
+        precip = forecast.get("precipitation", 0)
+        
+        weather_summary += f"{time} - {desc}, 気温: {temp}℃, 体感温度: {feels_like}℃，降水確率: {prob_precipitation}%，降水量: {precip}mm\n"
+    return weather_summary
+
+def load_prompt(template_path, **values):
+    """
+    プロンプトをファイルから読み込み、変数を埋め込む (ファイルが更新されるまでは読み込み直さない)
+
+    Returns:
+        tuple: (固定の指示, 変数を埋め込んだ可変部分)
+    """
+    try:
+        return prompts.render(template_path, **values)
+    except Exception as e:
+        print(f"プロンプトテンプレートの読み込みに失敗しました: {e}")
+        raise HTTPException(status_code=500, detail="Failed to load prompt template")
+
+def build_text_advice(prefecture, city, now, weather_summary, items, candidates, quick=False):
+    """
+    Markdown形式の服装提案を生成する
+    """
+    clothes_data = wardrobe.format_for_prompt(items, candidates) or "服装データが登録されていません。"
+    instruction, prompt = load_prompt(
+        "data/prompt_template.txt",
+        now_str=now.strftime("%Y年%m月%d日 %H時%M分"),
+        prefecture=prefecture,
+        city=city,
+        weather_summary=weather_summary,
+        clothes_data=clothes_data
+    )
+    
+    # デバッグ用にプロンプトをファイルに保存
+    with open("data/prompt.txt", "w", encoding="utf-8") as f:
+        f.write(instruction + "\n\n" + prompt + "\n")
+
+    return generate_with_gemini(prompt, f"{prefecture}_{city}", quick=quick, system_instruction=instruction)
+
+# 構造化出力(JSON)が途中で切れないよう、混雑時もこれ以上の出力トークン数を確保する
+STRUCTURED_MIN_OUTPUT_TOKENS = 1024
+
+def build_structured_advice(prefecture, city, now, weather_summary, items, candidates, quick=False):
+    """
+    構造化された服装提案を生成する。
+    天気パートは市ごと、服装パートは天気と衣類データの組み合わせごとにキャッシュし、必要な部分だけ生成する。
+    """
+    location = f"{prefecture}_{city}"
+    now_str = now.strftime("%Y年%m月%d日 %H時%M分")
+    clothes_list = wardrobe.names(items)
+
+    weather_part = structured_advice.get_weather_part(location, weather_summary)
+    if weather_part is None:
+        instruction, prompt = load_prompt(
+            "data/structured_weather_prompt_template.txt",
+            now_str=now_str, prefecture=prefecture, city=city, weather_summary=weather_summary
+        )
+        weather_part = structured_advice.parse_json(generate_with_gemini(
+            prompt, f"weather_{location}",
+            generation_config={"response_mime_type": "application/json", "response_schema": structured_advice.WEATHER_SCHEMA},
+            quick=quick, min_output_tokens=STRUCTURED_MIN_OUTPUT_TOKENS, system_instruction=instruction,
+        ))
+        structured_advice.put_weather_part(location, weather_summary, weather_part)
+
+    outfit_part = structured_advice.get_outfit_part(location, weather_summary, clothes_list)
+    if outfit_part is None:
+        instruction, prompt = load_prompt(
+            "data/structured_outfit_prompt_template.txt",
+            now_str=now_str, prefecture=prefecture, city=city, weather_summary=weather_summary,
+            clothes_data=structured_advice.format_clothes_with_ids(items, candidates) or "服装データが登録されていません。"
+        )
+        outfit_part = structured_advice.parse_json(generate_with_gemini(
+            prompt, f"outfit_{location}",
+            generation_config={"response_mime_type": "application/json", "response_schema": structured_advice.OUTFIT_SCHEMA},
+            quick=quick, min_output_tokens=STRUCTURED_MIN_OUTPUT_TOKENS, system_instruction=instruction,
+        ))
+        structured_advice.put_outfit_part(location, weather_summary, clothes_list, outfit_part)
+
+    return structured_advice.to_wire(weather_part, outfit_part, clothes_list)
+
+def build_advice(prefecture, city, advice_format="text", priority=scheduler.PRIORITY_INTERACTIVE, weather_data=None, quick=False):
+    """
+    天気予報の取得から服装提案の生成までを行い、/generate のレスポンスを返す。
+    weather_data を渡した場合は天気予報を取得し直さない。
+    quick=True の場合は短く速い回答を優先する。
+    """
+    if weather_data is None:
+        weather_data = fetch_weather(prefecture, city, priority=priority)
+    now = snapshot.now_jst()  # replayモードでは記録時点の時刻
+    today_forecasts = extract_today(weather_data, now)
+    weather_summary = summarize_today(today_forecasts)
+    daily_icon = weather_data.get("daily_icon", "")
+
+    # 衣類が多くてもプロンプトの大きさが一定になるよう、天気に合う候補だけを渡す
+    items = read_clothes_items()
+    candidates = select_clothes(items, today_forecasts)
+
+    try:
+        if advice_format == "structured":
+            response = {"structured": build_structured_advice(prefecture, city, now, weather_summary, items, candidates, quick), "daily_icon": daily_icon}
+        else:
+            response = {"generated_text": build_text_advice(prefecture, city, now, weather_summary, items, candidates, quick), "daily_icon": daily_icon}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error calling Gemini API: {e}")
+        error_detail = str(e)
+        raise HTTPException(status_code=500, detail=f"Failed to generate text: {error_detail}")
+
+    # この提案の元になった予報を、プッシュ配信で予報の変化を判定する基準にする
+    profile = digest.forecast_profile(today_forecasts)
+    push.note_advice(f"{prefecture}_{city}", advice_format, profile)
+    # クライアントが保存した提案を作り直す必要があるかを /generate/check で確認できるようにする
+    response["basis"] = {"profile": profile, "wardrobe_version": wardrobe.version(items)}
+    return response
+
+def generate_advice(prefecture_city):
+    """
+    /generate のレスポンスを作成する (ジョブのワーカーからも呼ぶ)
+    """
+    try:
+        prefecture, city = parse_location(prefecture_city.name)
+
+        # 購読中の場所は、朝に作成済みのダイジェストをそのまま返す
+        today_str = snapshot.now_jst().strftime("%Y-%m-%d")
+        cached = digest.get(prefecture_city.name, prefecture_city.format, today_str)
+        if cached is not None and cached["wardrobe_version"] == wardrobe_version():
+            push.note_advice(prefecture_city.name, prefecture_city.format, cached["profile"])
+            return {**cached["response"], "basis": {"profile": cached["profile"], "wardrobe_version": cached["wardrobe_version"]}}
+
+        return build_advice(prefecture, city, prefecture_city.format, quick=prefecture_city.quick)
+    except HTTPException:
+        raise
+    except (scheduler.QuotaExceededError, scheduler.UpstreamBusyError) as e:
+        raise upstream_unavailable(e)
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+
 @app.post("/generate", response_model = dict, summary="Generate text using Gemini")
-async def generate_text(prefecture_city: Prefecture_city):
+@profiler.profile_in_thread
+def generate_text(prefecture_city: Prefecture_city, request: Request):
     """
     データベース(clothes_list.txt)の内容と天気予報APIの情報を元に、Gemini APIを使用してテキストを生成。
+    format に "structured" を指定すると、1時間ごとの天気・活動時間ごとの服装(衣類ID)・雨具の要否を
+    短いキーの構造化データで返す (services/structured_advice.py の to_wire を参照)。
+    Accept: application/x-msgpack を指定すると MessagePack で返す。
+    """
+    # 生成中にイベントループを止めないよう、同期関数としてスレッドプールで実行する
+    return serialization.negotiate(request, generate_advice(prefecture_city))
+
+@app.post("/generate/check", response_model=dict, summary="Check whether saved advice is still current")
+def check_advice(basis: AdviceBasis):
     """
+    クライアントが保存している服装提案を作り直す必要があるかを返す (Geminiは呼ばない)。
+    basis から予報が服装に影響するほど変わったか、服一覧が変わった場合、または日付が変わって
+    比べられる時刻がない場合は stale が True になる。
+    """
+    prefecture, city = parse_location(basis.name)
     try:
-        parts = prefecture_city.name.split('_')
-        if len(parts) != 2:
-            raise HTTPException(status_code=400, detail="Invalid format. Expected 'prefecture_city'")
-        
-        prefecture, city = parts
-        
-        # clothes_list.txtからデータベース情報を取得
-        clothes_data = "服装データが登録されていません。"
-        try:
-            with open("data/clothes_list.txt", "r", encoding="utf-8") as f:
-                clothes_data = f.read().strip()
-                if not clothes_data:
-                    clothes_data = "服装データが登録されていません。"
-        except Exception as e:
-            print(f"Error reading clothes_list.txt: {e}")
-            # ファイルが読めなくてもエラーにはせず、デフォルトメッセージを使用
-        
-        # 天気情報を取得
-        api_key = os.getenv("OPENWEATHER_API_KEY")
-        if not api_key:
-            raise HTTPException(status_code=500, detail="OpenWeather API key not found")
-        
-        # 緯度経度の取得
-        coordinates = weather.get_lat_lon(prefecture, city)
-        if not coordinates:
-            raise HTTPException(status_code=404, detail=f"Location {prefecture}{city} not found")
-        
-        latitude, longitude = coordinates
-        weather_data = weather.get_weather_forecast_by_coords(latitude, longitude, api_key)
-        
-        if not weather_data:
-            raise HTTPException(status_code=500, detail="Failed to get weather forecast")
-        
-        # 天気情報から今日の予報を抽出
-        today_forecasts = []
-        utc_now = datetime.datetime.utcnow()
-        now = utc_now + datetime.timedelta(hours=9)
+        weather_data = fetch_weather(prefecture, city)
+    except (scheduler.QuotaExceededError, scheduler.UpstreamBusyError) as e:
+        raise upstream_unavailable(e)
+    profile = digest.forecast_profile(extract_today(weather_data, snapshot.now_jst()))
+
+    try:
+        saved_times = {row[0] for row in basis.profile}
+        stale = basis.wardrobe_version != wardrobe_version() \
+            or not any(row[0] in saved_times for row in profile) \
+            or digest.is_material_change(basis.profile, profile)
+    except (TypeError, ValueError, IndexError):
+        raise HTTPException(status_code=400, detail="Invalid basis")
+    if not stale:
+        push.note_advice(basis.name, basis.format, basis.profile)
+    return {"stale": stale}
+
+# GET /jobs/{job_id} で結果を待つ最大時間 (秒)
+JOBS_MAX_WAIT_SECONDS = 30
+
+def describe_job_error(e):
+    """ジョブで発生した例外を、/jobs/{job_id} で返す形式に変換する"""
+    if isinstance(e, HTTPException):
+        return {"status_code": e.status_code, "detail": e.detail, "retry_after": (e.headers or {}).get("Retry-After")}
+    if isinstance(e, jobs.JobExpiredError):
+        print(f"Job expired in the queue: {e}")
+        return {"status_code": 503, "detail": "混雑しています。しばらくしてから再度お試しください", "retry_after": "5"}
+    print(f"Unexpected error in job: {e}")
+    return {"status_code": 500, "detail": f"An unexpected error occurred: {str(e)}", "retry_after": None}
+
+def job_response(job):
+    body = {"job_id": job["id"], "status": job["status"]}
+    if job["status"] == jobs.STATUS_DONE:
+        body["result"] = job["result"]
+    elif job["status"] == jobs.STATUS_FAILED:
+        body["error"] = job["error"]
+    return body
+
+@app.post("/generate/jobs", response_model=dict, status_code=202, summary="Submit a /generate job")
+def submit_generate_job(prefecture_city: Prefecture_city):
+    """
+    /generate と同じ処理をジョブとして登録し、すぐにジョブIDを返す。
+    結果は GET /jobs/{job_id} で取得する (JOBS_RESULT_TTL_SECONDS の間だけ保持)。
+    """
+    # 不正なリクエストはジョブにせずにすぐ返す
+    parse_location(prefecture_city.name)
+    try:
+        job = jobs.submit(generate_advice, (prefecture_city,), describe_job_error)
+    except jobs.JobQueueFullError as e:
+        print(f"Job queue full: {e}")
+        raise HTTPException(status_code=503, detail="混雑しています。しばらくしてから再度お試しください", headers={"Retry-After": str(e.retry_after)})
+    return serialization.FastJSONResponse(
+        {"job_id": job["id"], "status": job["status"]},
+        status_code=202,
+        headers={"Location": f"/jobs/{job['id']}"},
+    )
+
+@app.get("/jobs/{job_id}", response_model=dict)
+async def get_job(job_id: str, request: Request, wait: float = 0):
+    """
+    ジョブの状態を取得する。wait (秒) を指定すると、ジョブが終了するまで最大 wait 秒待ってから返す。
+    終了したジョブは result (/generate と同じ形式) または error を含む。
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    await jobs.wait(job, min(wait, JOBS_MAX_WAIT_SECONDS))
+    return serialization.negotiate(request, job_response(jobs.to_dict(job)))
+
+@app.delete("/jobs/{job_id}", response_model=dict)
+def cancel_job(job_id: str):
+    """
+    ジョブをキャンセルする。実行中の場合、生成は止まらないが結果は破棄される。
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    jobs.cancel(job)
+    return job_response(jobs.to_dict(job))
+
+def refresh_digest(name, advice_format):
+    """
+    購読中の場所のダイジェストを作成する。
+    作成済みの場合は予報を取得し直し、服装に影響するほど変わっていたときだけ作り直す。
+
+    Returns:
+        bool: ダイジェストを作り直した場合は True
+    """
+    prefecture, city = parse_location(name)
+    weather_data = fetch_weather(prefecture, city, priority=scheduler.PRIORITY_BACKGROUND)
+    now = snapshot.now_jst()
+    today_str = now.strftime("%Y-%m-%d")
+    profile = digest.forecast_profile(extract_today(weather_data, now))
+
+    current_wardrobe = wardrobe_version()
+
+    current = digest.get(name, advice_format, today_str)
+    if current is not None and current["wardrobe_version"] == current_wardrobe \
+            and not digest.is_material_change(current["profile"], profile):
+        return False
+
+    response = build_advice(prefecture, city, advice_format, priority=scheduler.PRIORITY_BACKGROUND, weather_data=weather_data)
+    digest.put(name, advice_format, today_str, profile, current_wardrobe, response)
+    # 同じ場所を見ている接続中のクライアントにも届ける
+    push.publish(name, advice_format, response, profile)
+    return True
+
+def check_for_push(name, advice_format, baseline_profile):
+    """
+    接続中のクライアントが見ている場所の予報を取得し直し、
+    baseline_profile から服装に影響するほど変わっていれば服装提案を作り直す。
+
+    Returns:
+        tuple: (予報の要約, 新しい /generate のレスポンス。作り直さなかった場合は None)
+    """
+    prefecture, city = parse_location(name)
+    weather_data = fetch_weather(prefecture, city, priority=scheduler.PRIORITY_BACKGROUND)
+    profile = digest.forecast_profile(extract_today(weather_data, snapshot.now_jst()))
+    if baseline_profile is None or not digest.is_material_change(baseline_profile, profile):
+        return profile, None
+    return profile, build_advice(prefecture, city, advice_format, priority=scheduler.PRIORITY_BACKGROUND, weather_data=weather_data)
+
+PROMPT_TEMPLATES = [
+    "data/prompt_template.txt",
+    "data/structured_weather_prompt_template.txt",
+    "data/structured_outfit_prompt_template.txt",
+    "data/weekly_prompt_template.txt",
+]
+
+def warm_up_templates():
+    for template_path in PROMPT_TEMPLATES:
+        prompts.load(template_path)
+    return f"{len(PROMPT_TEMPLATES)} templates"
+
+def warm_up_wardrobe():
+    return f"{len(wardrobe.load_items())} items"
+
+def warm_up_gemini():
+    if not gemini_configured:
+        raise RuntimeError("Gemini API is not configured")
+    # テンプレートの固定の指示ごとにモデル (cached content) を作っておく
+    return model_router.warm_up([prompts.load(template_path)[0] for template_path in PROMPT_TEMPLATES])
+
+def warm_up_forecasts():
+    """購読中の場所の天気予報を取得しておく (最初の /generate で待たせないため)"""
+    names = {subscription["name"] for subscription in digest.list_subscriptions()}
+    for name in names:
+        prefecture, city = parse_location(name)
+        fetch_weather(prefecture, city, priority=scheduler.PRIORITY_BACKGROUND)
+    return f"{len(names)} locations"
+
+@app.on_event("startup")
+def start_warmup():
+    steps = [
+        ("templates", warm_up_templates, True),
+        ("wardrobe", warm_up_wardrobe, True),
+        # replayモードでは記録済みの出力を使うのでGeminiは必須ではない
+        ("gemini", warm_up_gemini, not snapshot.is_replay()),
+    ]
+    if not snapshot.is_replay():
+        # OpenWeatherに接続できなくても保存済みの予報で応答できるので、必須にはしない
+        steps.append(("openweather", weather.warm_up, False))
+        # イメージに含めたアイコン・フォントがなければ (ローカル実行など)、最初の表示で待たせないよう取得しておく
+        steps.append(("assets", assets.prefetch_all, False))
+        if health.WARMUP_PREFETCH:
+            steps.append(("forecasts", warm_up_forecasts, False))
+    health.start_warmup(steps)
+
+@app.get("/health/live", response_model=dict)
+def liveness():
+    """
+    プロセスが応答できるかどうか (準備中でも 200 を返す)
+    """
+    return {"status": "ok"}
+
+@app.get("/health/ready", response_model=dict)
+def readiness():
+    """
+    リクエストを受け付ける準備ができているかどうか。
+    起動時の準備 (テンプレート・服一覧の読み込み、Geminiの設定、外部APIへの接続) が終わるまでは 503 を返す。
+    """
+    status = health.status()
+    if not status["ready"]:
+        return serialization.FastJSONResponse(status, status_code=503)
+    return status
+
+@app.on_event("startup")
+def start_digest_scheduler():
+    digest.start_scheduler(refresh_digest)
+
+@app.on_event("startup")
+async def start_push_watcher():
+    push.start_watcher(check_for_push)
+
+@app.get("/events", summary="Stream advice updates (Server-Sent Events)")
+async def stream_events(name: str, request: Request, format: AdviceFormat = "text"):
+    """
+    指定した場所の服装提案の更新を Server-Sent Events で配信する。
+    予報が服装に影響するほど変わったときに、/generate と同じ形式のレスポンスを
+    "advice" イベントとして送る。接続を維持するため定期的にコメント行を送る。
+    """
+    parse_location(name)
+    return StreamingResponse(
+        push.stream(name, format, request.is_disconnected),
+        media_type="text/event-stream",
+        # 圧縮ミドルウェアやプロキシにバッファされないようにする
+        headers={"Cache-Control": "no-cache", "Content-Encoding": "identity", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/plan/week", response_model=dict, summary="Generate a weekly outfit plan using Gemini")
+@profiler.profile_in_thread
+def generate_weekly_plan(prefecture_city: Prefecture_city, request: Request):
+    """
+    週間天気予報(daily)を要約し、1週間分の服装を1回のGemini呼び出しで生成する。
+    生成結果は場所と日付ごとにキャッシュする。
+    """
+    try:
+        prefecture, city = parse_location(prefecture_city.name)
+        items = read_clothes_items()
+        now = snapshot.now_jst()
         today_str = now.strftime("%Y-%m-%d")
-        now_str = now.strftime("%Y年%m月%d日 %H時%M分")
 
-        daily_icon_url = weather_data.get("daily_icon_url", "")
-        
-        for forecast in weather_data.get("forecasts", []):
-            forecast_time = forecast.get("datetime", "")
-            if today_str in forecast_time:
-                today_forecasts.append(forecast)
-        
-        # 天気情報の要約を作成
-        weather_summary = "本日の天気情報:\n"
-        for forecast in today_forecasts:
-            time = forecast.get("datetime", "").split(" ")[1][:3]  # "HH時"のみ取得
-            desc = forecast.get("weather", {}).get("description", "不明")
-            temp = forecast.get("temperature", "不明")
-            feels_like = forecast.get("feels_like", "不明")
-            prob_precipitation = forecast.get("prob_precipitation", 0) * 100  # 確率をパーセントに変換
-            precip = forecast.get("precipitation", 0)
-            
-            weather_summary += f"{time} - {desc}, 気温: {temp}℃, 体感温度: {feels_like}℃，降水確率: {prob_precipitation}%，降水量: {precip}mm\n"
-
-        # プロンプトをファイルから読み込む
-        try:
-            with open("data/prompt_template.txt", "r", encoding="utf-8") as f:
-                prompt_template = f.read()
-                
-            # テンプレートに変数を埋め込む
-            prompt = prompt_template.format(
-                now_str=now_str,
-                prefecture=prefecture,
-                city=city,
-                weather_summary=weather_summary,
-                clothes_data=clothes_data
-            )
-        except Exception as e:
-            print(f"プロンプトテンプレートの読み込みに失敗しました: {e}")
-        
-        # デバッグ用にプロンプトをファイルに保存
-        with open("data/prompt.txt", "w", encoding="utf-8") as f:
-            f.write(prompt + "\n")
+        clothes_version = wardrobe.version(items)
+        cached = weekly_plan.get_cached(prefecture_city.name, today_str, clothes_version)
+        if cached is not None:
+            return serialization.negotiate(request, cached)
 
-        try:
-            response = model.generate_content(prompt)
+        weather_data = fetch_weather(prefecture, city)
+        weekly_summary = weekly_plan.summarize_daily(weather_data.get("daily", []), now.date())
+        if not weekly_summary:
+            raise HTTPException(status_code=500, detail="Failed to get daily weather forecast")
+
+        # 週間の体感温度・降水確率に合う候補だけをプロンプトに渡す
+        week = [day for day in weather_data.get("daily", []) if day["date"] >= today_str][:weekly_plan.WEEKLY_PLAN_DAYS]
+        candidates = select_clothes(items, week)
+        clothes_data = wardrobe.format_for_prompt(items, candidates) or "服装データが登録されていません。"
 
-            if hasattr(response, 'text'):
-                generated_text = response.text
-            elif response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
-                generated_text = "".join(part.text for part in response.candidates[0].content.parts)
-            else:
-                print(f"Unexpected Gemini API response format: {response}")
-                raise HTTPException(status_code=500, detail="Failed to parse Gemini API response")
+        instruction, prompt = load_prompt(
+            "data/weekly_prompt_template.txt",
+            now_str=now.strftime("%Y年%m月%d日 %H時%M分"),
+            prefecture=prefecture,
+            city=city,
+            weekly_summary=weekly_summary,
+            clothes_data=clothes_data
+        )
 
-            return {"generated_text": generated_text, "daily_icon_url": daily_icon_url}
+        try:
+            generated_text = generate_with_gemini(
+                prompt, f"week_{prefecture_city.name}", quick=prefecture_city.quick, system_instruction=instruction
+            )
+        except HTTPException:
+            raise
         except Exception as e:
             print(f"Error calling Gemini API: {e}")
-            error_detail = str(e)
-            raise HTTPException(status_code=500, detail=f"Failed to generate text: {error_detail}")
+            raise HTTPException(status_code=500, detail=f"Failed to generate text: {str(e)}")
+
+        plan = {
+            "generated_text": generated_text,
+            "days": [{"date": day["date"], "icon": day["weather"]["icon"]} for day in week],
+        }
+        weekly_plan.put(prefecture_city.name, today_str, clothes_version, plan)
+        return serialization.negotiate(request, plan)
     except HTTPException:
         raise
+    except (scheduler.QuotaExceededError, scheduler.UpstreamBusyError) as e:
+        raise upstream_unavailable(e)
     except Exception as e:
         print(f"Unexpected error: {e}")
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
+def wants_minimal(request):
+    """Prefer: return=minimal の場合は、変更後の服一覧を返さずに 204 で応答する"""
+    return "return=minimal" in request.headers.get("prefer", "")
+
+MINIMAL_RESPONSE_HEADERS = {"Preference-Applied": "return=minimal"}
+
 @app.post("/register", response_model=list[str])
-def add_clothes(clothes: Clothes):
-    new_clothes = clothes.name
-    # ファイルに追記
-    with open("data/clothes_list.txt", "a") as f:
-        f.write(new_clothes + "\n")
-    # ファイルから全ての服装を読み込む
-    with open("data/clothes_list.txt", "r") as f:
-        clothes_list = [line.strip() for line in f.readlines() if line.strip()]
-    return clothes_list
+def add_clothes(clothes: Clothes, request: Request):
+    """
+    服を登録し、登録後の服一覧を返す。
+    Prefer: return=minimal を指定すると一覧を返さずに 204 で応答する。
+    """
+    error = wardrobe.validate(clothes.name, clothes.category)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    # ファイルに追記し、全ての服装を読み込む
+    clothes_list = wardrobe.append(clothes.name, clothes.category, reload=not wants_minimal(request))
+    if clothes_list is None:
+        return Response(status_code=204, headers=MINIMAL_RESPONSE_HEADERS)
+    return wardrobe.names(clothes_list)
 
 @app.post("/delete", response_model=list[str])
-def delete_clothes(clothes: ClothesToDelete):
+def delete_clothes(clothes: ClothesToDelete, request: Request):
     """
     指定された服装をデータベース(clothes_list.txt)から削除。
+    Prefer: return=minimal を指定すると削除後の一覧を返さずに 204 で応答する。
     """
     clothes_to_delete = clothes.name
     
     try:
-        # ファイルから服装リストを読み込む
-        with open("data/clothes_list.txt", "r", encoding="utf-8") as f:
-            clothes_list = [line.strip() for line in f.readlines() if line.strip()]
-        
-        # 削除対象の服装がリストにあるか確認
-        if clothes_to_delete not in clothes_list:
+        # 服装を削除し、更新されたリストをファイルに書き込む
+        try:
+            clothes_list = wardrobe.remove(clothes_to_delete)
+        except KeyError:
             raise HTTPException(status_code=404, detail=f"衣類 '{clothes_to_delete}' は見つかりませんでした")
         
-        # 服装を削除
-        clothes_list.remove(clothes_to_delete)
-        
-        # 更新されたリストをファイルに書き込む
-        with open("data/clothes_list.txt", "w", encoding="utf-8") as f:
-            for item in clothes_list:
-                f.write(f"{item}\n")
-        
-        return clothes_list
+        if wants_minimal(request):
+            return Response(status_code=204, headers=MINIMAL_RESPONSE_HEADERS)
+        return wardrobe.names(clothes_list)
     except HTTPException:
         raise
     except Exception as e:
@@ -212,16 +704,118 @@ def delete_clothes(clothes: ClothesToDelete):
         raise HTTPException(status_code=500, detail=f"服装の削除中にエラーが発生しました: {str(e)}")
     
 @app.get("/list", response_model=list[str])
-def get_clothes_list():
+def get_clothes_list(request: Request):
     """
-    保存されている服のリストを取得する
+    保存されている服のリストを取得する。
+    Accept: application/x-msgpack を指定すると MessagePack で返す。
     """
     try:
         # ファイルから服装リストを読み込む
-        with open("data/clothes_list.txt", "r", encoding="utf-8") as f:
-            clothes_list = [line.strip() for line in f.readlines() if line.strip()]
+        clothes_list = wardrobe.names(wardrobe.load_items())
         
-        return clothes_list
+        return serialization.negotiate(request, clothes_list)
     except Exception as e:
         print(f"服装リストの取得中にエラーが発生しました: {e}")
-        return []  # エラー時は空のリストを返す
+        return serialization.negotiate(request, [])  # エラー時は空のリストを返す
+
+WARDROBE_FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+@app.post("/import", response_model=dict)
+async def import_clothes(request: Request, format: WardrobeFormat = "csv"):
+    """
+    服をまとめて登録する。リクエストボディは CSV (name,category) または JSON Lines。
+    すべての行を検証してから1回で書き込み、1行でも不正な行があれば何も登録しない。
+    すでに登録されている名前の服は追加しない。
+    """
+    # ボディを受信しながら行に分割する
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    lines, pending = [], ""
+    max_lines = wardrobe.IMPORT_MAX_ITEMS * 2
+    try:
+        async for chunk in request.stream():
+            pending += decoder.decode(chunk)
+            *complete, pending = pending.split("\n")
+            lines.extend(line.rstrip("\r") for line in complete)
+            if len(lines) > max_lines:
+                raise HTTPException(status_code=413, detail=f"一度にインポートできるのは {wardrobe.IMPORT_MAX_ITEMS} 件までです")
+        pending += decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="UTF-8として読み込めません")
+    if pending:
+        lines.append(pending.rstrip("\r"))
+
+    # 解析と書き込み (ロックを取ってファイルを書き換える) はイベントループを止めないようスレッドで実行する
+    entries, errors = await run_in_threadpool(wardrobe.parse_import, lines, format)
+    if errors:
+        raise HTTPException(status_code=400, detail={"message": "不正な行があるためインポートしませんでした", "errors": errors[:100]})
+
+    try:
+        added, skipped, items = await run_in_threadpool(wardrobe.import_items, entries)
+    except Exception as e:
+        print(f"服装のインポート中にエラーが発生しました: {e}")
+        raise HTTPException(status_code=500, detail=f"服装のインポート中にエラーが発生しました: {str(e)}")
+    return {"imported": added, "skipped": skipped, "total": len(items)}
+
+@app.get("/export", summary="Stream the wardrobe as CSV or JSON Lines")
+def export_clothes(format: WardrobeFormat = "csv"):
+    """
+    登録されている服を CSV (name,category) または JSON Lines で1行ずつ返す。
+    """
+    return StreamingResponse(
+        wardrobe.export_lines(format),
+        media_type=WARDROBE_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="clothes_list.{format}"'},
+    )
+
+@app.get("/subscriptions", response_model=list[dict])
+def get_subscriptions():
+    """
+    朝のダイジェストを作成する場所の一覧を取得する
+    """
+    return digest.list_subscriptions()
+
+@app.post("/subscriptions", response_model=list[dict])
+def add_subscription(prefecture_city: Prefecture_city):
+    """
+    場所を購読する。毎朝 DIGEST_TIME に服装提案を作成しておき、/generate で即座に返す。
+    """
+    parse_location(prefecture_city.name)
+    digest.subscribe(prefecture_city.name, prefecture_city.format)
+    return digest.list_subscriptions()
+
+@app.post("/subscriptions/delete", response_model=list[dict])
+def delete_subscription(prefecture_city: Prefecture_city):
+    """
+    場所の購読を解除する
+    """
+    if not digest.unsubscribe(prefecture_city.name, prefecture_city.format):
+        raise HTTPException(status_code=404, detail=f"{prefecture_city.name} は購読されていません")
+    return digest.list_subscriptions()
+
+@app.get("/upstream/usage", response_model=dict)
+def get_upstream_usage():
+    """
+    外部API(Nominatim, OpenWeather)ごとのレート制限・クォータの使用状況と、
+    天気予報キャッシュ・Geminiのモデル選択の状況を取得する
+    """
+    return {**scheduler.get_usage(), "forecast_cache": forecast_cache.stats(), "gemini_router": model_router.stats(), "jobs": jobs.stats(), "admission": admission.stats()}
+
+@app.get("/static/icons/{code}.png")
+def get_weather_icon(code: str):
+    """
+    天気アイコン(OpenWeatherのアイコンコード)を配信する
+    """
+    path = assets.icon_path(code)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Icon {code} not found")
+    return FileResponse(path, media_type="image/png", headers={"Cache-Control": assets.CACHE_CONTROL})
+
+@app.get("/static/fonts/{filename}")
+def get_font(filename: str):
+    """
+    自前で配信するWebフォントを返す
+    """
+    path = assets.font_path(filename)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Font {filename} not found")
+    return FileResponse(path, media_type=assets.FONT_MEDIA_TYPE, headers={"Cache-Control": assets.CACHE_CONTROL})
@@ -0,0 +1,229 @@
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+import json
+
+# すべての制限対象エンドポイントで同時に処理するリクエスト数の上限
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "16"))
+_EWMA_ALPHA = 0.2
+
+
+class EndpointClass:
+    """
+    同じ制限を受けるエンドポイントのグループ
+
+    priority が小さいほど、全体の上限に空きが出たときに先に処理される。
+    """
+
+    def __init__(self, name, priority, max_concurrency, max_queue, timeout):
+        self.name = name
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout  # 待ち行列で待てる最大時間 (秒)
+
+        self.in_flight = 0
+        self.queued = 0
+        self.service_ewma = None  # 1リクエストの処理時間の指数移動平均 (秒)
+        self.admitted = 0
+        self.rejected = 0
+
+    def estimated_wait(self, position):
+        """待ち行列の position 番目 (0始まり) のリクエストが処理を始めるまでの見込み時間"""
+        if self.service_ewma is None:
+            return 0.0
+        return (position // max(self.max_concurrency, 1) + 1) * self.service_ewma
+
+
+# 安いエンドポイント (服一覧) は高価なエンドポイント (Geminiでの生成) より優先する
+CLASSES = {
+    "wardrobe": EndpointClass(
+        "wardrobe", priority=0,
+        max_concurrency=int(os.getenv("ADMISSION_WARDROBE_CONCURRENCY", "8")),
+        max_queue=int(os.getenv("ADMISSION_WARDROBE_QUEUE", "64")),
+        timeout=float(os.getenv("ADMISSION_WARDROBE_TIMEOUT_SECONDS", "2")),
+    ),
+    "generate": EndpointClass(
+        "generate", priority=1,
+        max_concurrency=int(os.getenv("ADMISSION_GENERATE_CONCURRENCY", "4")),
+        max_queue=int(os.getenv("ADMISSION_GENERATE_QUEUE", "16")),
+        timeout=float(os.getenv("ADMISSION_GENERATE_TIMEOUT_SECONDS", "10")),
+    ),
+}
+
+# パス -> グループ名 (ここにないパスは制限しない)。
+# /generate/jobs はここでは制限しない (登録はすぐ終わるため)。フロントエンドの服装提案はすべてジョブで
+# 生成するので、実際の受付の上限はジョブのキュー (services/jobs.py の JOBS_MAX_QUEUED と
+# JOBS_QUEUE_DEADLINE_SECONDS) で、期限内に始められない見込みのジョブは登録時に 503 で断る
+ENDPOINTS = {
+    "/list": "wardrobe",
+    "/register": "wardrobe",
+    "/delete": "wardrobe",
+    "/import": "wardrobe",
+    "/generate": "generate",
+    "/plan/week": "generate",
+}
+
+_total_in_flight = 0
+_waiters = []  # (priority, seq, EndpointClass, asyncio.Future) のヒープ
+_seq = itertools.count()
+
+
+class Rejected(Exception):
+    def __init__(self, endpoint_class, reason, retry_after):
+        super().__init__(reason)
+        self.endpoint_class = endpoint_class
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def _can_start(endpoint_class):
+    return endpoint_class.in_flight < endpoint_class.max_concurrency and _total_in_flight < ADMISSION_MAX_CONCURRENCY
+
+
+def _start(endpoint_class):
+    global _total_in_flight
+    endpoint_class.in_flight += 1
+    endpoint_class.admitted += 1
+    _total_in_flight += 1
+
+
+def _wake_waiters():
+    """空きができたら、優先度の高い順に待っているリクエストを開始させる"""
+    skipped = []
+    while _waiters and _total_in_flight < ADMISSION_MAX_CONCURRENCY:
+        entry = heapq.heappop(_waiters)
+        _, _, endpoint_class, future = entry
+        if future.done():
+            continue  # タイムアウトしたリクエスト
+        if endpoint_class.in_flight >= endpoint_class.max_concurrency:
+            skipped.append(entry)  # このグループは満杯なので、次のグループのリクエストを見る
+            continue
+        endpoint_class.queued -= 1
+        _start(endpoint_class)
+        future.set_result(True)
+    for entry in skipped:
+        heapq.heappush(_waiters, entry)
+
+
+def _retry_after(endpoint_class):
+    return max(1, math.ceil(endpoint_class.estimated_wait(endpoint_class.queued)))
+
+
+async def acquire(endpoint_class):
+    """
+    処理を始めてよくなるまで待つ
+
+    Raises:
+        Rejected: 待ち行列が満杯、または timeout 秒以内に処理を始められない場合
+    """
+    # 同じか高い優先度で、空きを待っているリクエストがあれば追い越さない
+    waiting_ahead = any(
+        not future.done() and priority <= endpoint_class.priority
+        and (waiting_class is endpoint_class or waiting_class.in_flight < waiting_class.max_concurrency)
+        for priority, _, waiting_class, future in _waiters
+    )
+    if _can_start(endpoint_class) and not waiting_ahead:
+        _start(endpoint_class)
+        return
+
+    # 待っても間に合わないリクエストは、待たせずにすぐ断る
+    if endpoint_class.queued >= endpoint_class.max_queue:
+        endpoint_class.rejected += 1
+        raise Rejected(endpoint_class, "queue full", _retry_after(endpoint_class))
+    if endpoint_class.estimated_wait(endpoint_class.queued) > endpoint_class.timeout:
+        endpoint_class.rejected += 1
+        raise Rejected(endpoint_class, "deadline", _retry_after(endpoint_class))
+
+    future = asyncio.get_running_loop().create_future()
+    heapq.heappush(_waiters, (endpoint_class.priority, next(_seq), endpoint_class, future))
+    endpoint_class.queued += 1
+    try:
+        await asyncio.wait_for(asyncio.shield(future), endpoint_class.timeout)
+    except asyncio.TimeoutError:
+        if future.done():
+            return  # タイムアウトと同時に開始できた
+        future.cancel()
+        endpoint_class.queued -= 1
+        endpoint_class.rejected += 1
+        raise Rejected(endpoint_class, "timeout", _retry_after(endpoint_class))
+    except asyncio.CancelledError:
+        # クライアントが切断した
+        if future.done() and not future.cancelled():
+            release(endpoint_class, None)
+        else:
+            future.cancel()
+            endpoint_class.queued -= 1
+        raise
+
+
+def release(endpoint_class, elapsed):
+    global _total_in_flight
+    endpoint_class.in_flight -= 1
+    _total_in_flight -= 1
+    if elapsed is not None:
+        endpoint_class.service_ewma = elapsed if endpoint_class.service_ewma is None else \
+            _EWMA_ALPHA * elapsed + (1 - _EWMA_ALPHA) * endpoint_class.service_ewma
+    _wake_waiters()
+
+
+def stats():
+    return {
+        "max_concurrency": ADMISSION_MAX_CONCURRENCY,
+        "in_flight": _total_in_flight,
+        "classes": {
+            name: {
+                "in_flight": endpoint_class.in_flight,
+                "queued": endpoint_class.queued,
+                "admitted": endpoint_class.admitted,
+                "rejected": endpoint_class.rejected,
+                "service_ewma_seconds": round(endpoint_class.service_ewma, 3) if endpoint_class.service_ewma is not None else None,
+                "max_concurrency": endpoint_class.max_concurrency,
+                "max_queue": endpoint_class.max_queue,
+                "timeout_seconds": endpoint_class.timeout,
+            }
+            for name, endpoint_class in CLASSES.items()
+        },
+    }
+
+
+class AdmissionMiddleware:
+    """
+    エンドポイントのグループごとに同時実行数と待ち行列を制限するASGIミドルウェア。
+    待ち時間内に処理を始められないリクエストには、すぐに 503 と Retry-After を返す。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        endpoint_class = CLASSES.get(ENDPOINTS.get(scope.get("path"))) if scope["type"] == "http" else None
+        if endpoint_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await acquire(endpoint_class)
+        except Rejected as e:
+            print(f"リクエストを受け付けませんでした ({scope.get('path')}, {e.reason})")
+            body = json.dumps({"detail": "混雑しています。しばらくしてから再度お試しください"}, ensure_ascii=False).encode("utf-8")
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode("latin-1")),
+                    (b"retry-after", str(e.retry_after).encode("latin-1")),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            release(endpoint_class, time.monotonic() - started)
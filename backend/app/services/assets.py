@@ -0,0 +1,155 @@
+import os
+import re
+import requests
+
+# Dockerイメージでは開発用にマウントするアプリのディレクトリの外 (/opt/assets) に置く
+STATIC_DIR = os.getenv("STATIC_DIR", "static")
+ICON_DIR = os.path.join(STATIC_DIR, "icons")
+FONT_DIR = os.path.join(STATIC_DIR, "fonts")
+
+# ブラウザに長期間キャッシュさせる (ファイル名が変わらない限り内容も変わらない)
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# OpenWeatherの天気アイコンコード一覧 (d: 昼, n: 夜)
+ICON_CODES = [
+    f"{number}{suffix}"
+    for number in ("01", "02", "03", "04", "09", "10", "11", "13", "50")
+    for suffix in ("d", "n")
+]
+ICON_SOURCE_URL = "https://openweathermap.org/img/wn/{code}@2x.png"
+
+# 自前で配信するフォント (ファイル名: 取得元URL)。
+# 取得元は全文字を含む可変ウェイトのTTF (数MB) なので、ASCIIと JIS X 0208 の非漢字・第1水準漢字だけを残した
+# WOFF2 に変換して配信する。含まれない文字は端末のフォントで表示される
+FONTS = {
+    "NotoSansJP-subset.woff2": "https://github.com/google/fonts/raw/main/ofl/notosansjp/NotoSansJP%5Bwght%5D.ttf",
+}
+FONT_MEDIA_TYPE = "font/woff2"
+
+_ICON_CODE_PATTERN = re.compile(r"^\d{2}[dn]$")
+
+
+def _download(url, path):
+    try:
+        response = requests.get(url, timeout=30)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print(f"アセットの取得に失敗しました ({url}): {e}")
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(response.content)
+    os.replace(tmp_path, path)
+    return True
+
+
+def _subset_text():
+    """サブセットに含める文字 (ASCII と JIS X 0208 の1〜47区)"""
+    chars = {chr(code) for code in range(0x20, 0x7f)}
+    # EUC-JPの1バイト目 0xA1〜0xCF が1〜47区 (48区以降は第2水準漢字)
+    for first in range(0xA1, 0xD0):
+        for second in range(0xA1, 0xFF):
+            try:
+                chars.add(bytes((first, second)).decode("euc_jp"))
+            except UnicodeDecodeError:
+                pass  # 未定義の区点
+    return "".join(sorted(chars))
+
+
+def _subset_font(url, path):
+    """取得元のフォントをダウンロードし、文字を絞った WOFF2 にして path に保存する"""
+    try:
+        from fontTools import subset
+    except ImportError:
+        print("fonttools がインストールされていないため、フォントを作成できませんでした")
+        return False
+
+    source_path = f"{path}.source"
+    if not _download(url, source_path):
+        return False
+    tmp_path = f"{path}.tmp"
+    try:
+        options = subset.Options()
+        options.flavor = "woff2"
+        font = subset.load_font(source_path, options)
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(text=_subset_text())
+        subsetter.subset(font)
+        subset.save_font(font, tmp_path, options)
+        os.replace(tmp_path, path)
+        return True
+    except Exception as e:
+        print(f"フォントのサブセット化に失敗しました ({url}): {e}")
+        return False
+    finally:
+        for leftover in (source_path, tmp_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def icon_path(code):
+    """
+    天気アイコンのローカルパスを返す。手元にない場合は一度だけ取得して保存する。
+
+    Returns:
+        str | None: ファイルパス。不正なコードや取得に失敗した場合は None
+    """
+    if not _ICON_CODE_PATTERN.match(code):
+        return None
+    path = os.path.join(ICON_DIR, f"{code}.png")
+    if not os.path.exists(path) and not _download(ICON_SOURCE_URL.format(code=code), path):
+        return None
+    return path
+
+
+def font_path(filename):
+    """
+    フォントのローカルパスを返す。手元にない場合は一度だけ取得・サブセット化して保存する。
+
+    Returns:
+        str | None: ファイルパス。未登録のフォントや取得に失敗した場合は None
+    """
+    if filename not in FONTS:
+        return None
+    path = os.path.join(FONT_DIR, filename)
+    if not os.path.exists(path) and not _subset_font(FONTS[filename], path):
+        return None
+    return path
+
+
+def prefetch_all():
+    """
+    すべての天気アイコンとフォントを事前に取得する。
+    Dockerイメージのビルド時と、起動時の準備 (手元にないものだけ取得する) で実行する。
+    """
+    icons = sum(1 for code in ICON_CODES if icon_path(code) is not None)
+    fonts = sum(1 for filename in FONTS if font_path(filename) is not None)
+    if icons < len(ICON_CODES) or fonts < len(FONTS):
+        raise RuntimeError(f"{icons}/{len(ICON_CODES)} icons, {fonts}/{len(FONTS)} fonts")
+    return f"{icons} icons, {fonts} fonts"
+
+
+class UncompressedStaticMiddleware:
+    """
+    圧縮ミドルウェア (compressor) を /static 以外のパスにだけ適用するASGIミドルウェア。
+    アイコン (PNG) とフォント (WOFF2) は圧縮済みの形式なので、圧縮し直してもCPUを使うだけで小さくならない。
+    """
+
+    def __init__(self, app, compressor, **options):
+        self.app = app
+        self.compressed_app = compressor(app, **options)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope.get("path", "").startswith("/static/"):
+            await self.app(scope, receive, send)
+            return
+        await self.compressed_app(scope, receive, send)
+
+
+if __name__ == "__main__":
+    # 取得できなかったものは起動時や最初のリクエストで取得し直すので、ビルドは止めない
+    try:
+        print(prefetch_all())
+    except RuntimeError as e:
+        print(f"取得できなかったアセットがあります: {e}")
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import datetime
+import threading
+import services.wardrobe as wardrobe
+
+SUBSCRIPTIONS_PATH = os.getenv("DIGEST_SUBSCRIPTIONS_PATH", "data/subscriptions.json")
+DIGESTS_PATH = os.getenv("DIGEST_STORE_PATH", "data/digests.json")
+# 朝のダイジェストを作成する時刻 (JST, HH:MM)
+DIGEST_TIME = os.getenv("DIGEST_TIME", "06:00")
+# ダイジェスト作成後、予報の変化を確認する間隔 (分)
+DIGEST_REFRESH_MINUTES = int(os.getenv("DIGEST_REFRESH_MINUTES", "60"))
+DIGEST_ENABLED = os.getenv("DIGEST_ENABLED", "1") == "1"
+
+# 「予報が大きく変わった」とみなす基準
+MATERIAL_TEMP_DELTA = float(os.getenv("DIGEST_TEMP_DELTA", "2.0"))  # 体感温度の差 (℃)
+MATERIAL_POP_THRESHOLD = 0.5  # 雨具を提案する降水確率 (prompt_template.txt と同じ)
+_WET_WEATHER = {"Rain", "Drizzle", "Thunderstorm", "Snow"}
+
+_lock = threading.Lock()
+_subscriptions = None
+_digests = None
+_scheduler_thread = None
+
+
+def _jst_now():
+    return datetime.datetime.utcnow() + datetime.timedelta(hours=9)
+
+
+def _load_json(path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except Exception as e:
+        print(f"{path} の読み込みに失敗しました: {e}")
+        return default
+
+
+def _save_json(path, data):
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"{path} の保存に失敗しました: {e}")
+
+
+def _ensure_loaded():
+    global _subscriptions, _digests
+    if _subscriptions is None:
+        _subscriptions = _load_json(SUBSCRIPTIONS_PATH, [])
+    if _digests is None:
+        _digests = _load_json(DIGESTS_PATH, {})
+
+
+# ---- 購読 ----
+
+def list_subscriptions():
+    with _lock:
+        _ensure_loaded()
+        return [dict(subscription) for subscription in _subscriptions]
+
+
+def subscribe(name, advice_format):
+    """
+    場所を購読する (毎朝ダイジェストを作成する対象にする)
+
+    Returns:
+        bool: 新しく購読した場合は True
+    """
+    with _lock:
+        _ensure_loaded()
+        if any(s["name"] == name and s["format"] == advice_format for s in _subscriptions):
+            return False
+        _subscriptions.append({"name": name, "format": advice_format})
+        _save_json(SUBSCRIPTIONS_PATH, _subscriptions)
+        return True
+
+
+def unsubscribe(name, advice_format):
+    """
+    購読を解除する
+
+    Returns:
+        bool: 購読していた場合は True
+    """
+    with _lock:
+        _ensure_loaded()
+        remaining = [s for s in _subscriptions if not (s["name"] == name and s["format"] == advice_format)]
+        if len(remaining) == len(_subscriptions):
+            return False
+        _subscriptions[:] = remaining
+        _digests.pop(_digest_key(name, advice_format), None)
+        _save_json(SUBSCRIPTIONS_PATH, _subscriptions)
+        _save_json(DIGESTS_PATH, _digests)
+        return True
+
+
+# ---- 予報のバージョン ----
+
+def forecast_profile(today_forecasts):
+    """
+    服装に影響する要素だけを残した予報の要約 (時刻, 体感温度, 降水確率, 天気)
+    """
+    return [
+        [
+            forecast.get("datetime", ""),
+            round(forecast.get("feels_like", 0), 1),
+            round(forecast.get("prob_precipitation", 0), 2),
+            forecast.get("weather", {}).get("main", ""),
+        ]
+        for forecast in today_forecasts
+    ]
+
+
+def forecast_version(profile):
+    return wardrobe.fingerprint(json.dumps(profile))
+
+
+def is_material_change(old_profile, new_profile):
+    """
+    服装の提案が変わりうるほど予報が変わったかどうか。
+    時間が経って過ぎた時刻が消えるのは変化とみなさず、共通する時刻だけを比べる。
+    """
+    old_by_time = {row[0]: row for row in old_profile}
+    for time_str, feels_like, pop, main in new_profile:
+        old = old_by_time.get(time_str)
+        if old is None:
+            continue
+        _, old_feels_like, old_pop, old_main = old
+        if abs(feels_like - old_feels_like) >= MATERIAL_TEMP_DELTA:
+            return True
+        if (pop >= MATERIAL_POP_THRESHOLD) != (old_pop >= MATERIAL_POP_THRESHOLD):
+            return True
+        if (main in _WET_WEATHER) != (old_main in _WET_WEATHER):
+            return True
+    return False
+
+
+# ---- ダイジェストの保存 ----
+
+def _digest_key(name, advice_format):
+    return f"{name}|{advice_format}"
+
+
+def get(name, advice_format, date_str):
+    """
+    指定した日のダイジェストを返す。なければ None
+
+    Returns:
+        dict: {"date", "forecast_version", "wardrobe_version", "profile", "response", "generated_at"}
+    """
+    with _lock:
+        _ensure_loaded()
+        entry = _digests.get(_digest_key(name, advice_format))
+    if entry is None or entry["date"] != date_str:
+        return None
+    return entry
+
+
+def put(name, advice_format, date_str, profile, wardrobe_version, response):
+    with _lock:
+        _ensure_loaded()
+        _digests[_digest_key(name, advice_format)] = {
+            "date": date_str,
+            "forecast_version": forecast_version(profile),
+            "wardrobe_version": wardrobe_version,
+            "profile": profile,
+            "response": response,
+            "generated_at": _jst_now().isoformat(timespec="seconds"),
+        }
+        _save_json(DIGESTS_PATH, _digests)
+
+
+# ---- 定期実行 ----
+
+def _digest_time_today(now):
+    hour, minute = (int(value) for value in DIGEST_TIME.split(":"))
+    return now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+
+def refresh_all(refresh_fn):
+    """購読中のすべての場所について refresh_fn(name, advice_format) を呼ぶ"""
+    for subscription in list_subscriptions():
+        try:
+            if refresh_fn(subscription["name"], subscription["format"]):
+                print(f"ダイジェストを更新しました: {subscription['name']} ({subscription['format']})")
+        except Exception as e:
+            print(f"ダイジェストの更新に失敗しました ({subscription['name']}): {e}")
+
+
+def _run_scheduler(refresh_fn):
+    last_refresh = None
+    while True:
+        now = _jst_now()
+        # 毎朝 DIGEST_TIME 以降、DIGEST_REFRESH_MINUTES ごとに更新を確認する
+        if now >= _digest_time_today(now):
+            if last_refresh is None or last_refresh.date() != now.date() or \
+                    now - last_refresh >= datetime.timedelta(minutes=DIGEST_REFRESH_MINUTES):
+                refresh_all(refresh_fn)
+                last_refresh = now
+        time.sleep(30)
+
+
+def start_scheduler(refresh_fn):
+    """
+    ダイジェストを定期的に作成・更新するバックグラウンドスレッドを開始する
+
+    Args:
+        refresh_fn: refresh_fn(name, advice_format) -> bool。
+            ダイジェストが無いか予報が大きく変わっていれば作り直し、作り直した場合は True を返す
+    """
+    global _scheduler_thread
+    if not DIGEST_ENABLED or _scheduler_thread is not None:
+        return
+    _scheduler_thread = threading.Thread(target=_run_scheduler, args=(refresh_fn,), daemon=True, name="digest-scheduler")
+    _scheduler_thread.start()
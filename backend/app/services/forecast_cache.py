@@ -0,0 +1,121 @@
+import os
+import math
+import time
+import threading
+
+# この距離(km)以内の地点は同じ天気予報を共有する (新宿区・渋谷区・港区などの隣接区)
+FORECAST_SHARE_KM = float(os.getenv("FORECAST_SHARE_KM", "5"))
+# 天気予報を再利用する期間 (秒)。One Call APIの予報はおよそ10分ごとに更新される
+FORECAST_CACHE_TTL_SECONDS = int(os.getenv("FORECAST_CACHE_TTL_SECONDS", "600"))
+# 同じマスの取得を待つ最大時間 (秒, 対話的なリクエストのみ)。超えたら待たずに自分で取得する
+FORECAST_FETCH_WAIT_SECONDS = float(os.getenv("FORECAST_FETCH_WAIT_SECONDS", "2"))
+
+# グリッドの1マスの大きさ (度)。南北方向は共有距離と同じくらいにして、上下1マスだけを探せば済むようにする
+_CELL_DEGREES = max(FORECAST_SHARE_KM / 111.0, 0.001)
+_EARTH_RADIUS_KM = 6371.0
+
+_lock = threading.Lock()
+_cells = {}        # (行, 列) -> [{"lat", "lon", "fetched_at", "forecast"}, ...]
+_fetch_locks = {}  # (行, 列) -> threading.Lock (同じマスへの同時取得をまとめる)
+_stats = {"hits": 0, "misses": 0, "shared": 0, "wait_timeouts": 0}
+
+
+def _cell(lat, lon):
+    return (math.floor(lat / _CELL_DEGREES), math.floor(lon / _CELL_DEGREES))
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """2地点間の距離 (km, ハーバーサイン公式)"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = math.radians(lat2 - lat1)
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * _EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def _column_span(lat):
+    """
+    東西方向に探すマス数 (片側)。経度1度の長さは cos(緯度) 倍に縮むので
+    (東京ではおよそ0.81倍)、共有距離に届くまで隣のマスを余分に探す
+    """
+    # 上下のマスのうち極に近い側の緯度で計算する
+    edge_lat = min(abs(lat) + _CELL_DEGREES, 90.0)
+    cos_lat = math.cos(math.radians(edge_lat))
+    max_span = math.ceil(180.0 / _CELL_DEGREES)
+    if cos_lat <= 0:
+        return max_span
+    return min(math.ceil(1 / cos_lat), max_span)
+
+
+def _nearest(lat, lon, now):
+    row, col = _cell(lat, lon)
+    col_span = _column_span(lat)
+    best, best_distance = None, None
+    for d_row in (-1, 0, 1):
+        for d_col in range(-col_span, col_span + 1):
+            entries = _cells.get((row + d_row, col + d_col), [])
+            # 期限切れのエントリはついでに捨てる
+            entries[:] = [entry for entry in entries if now - entry["fetched_at"] < FORECAST_CACHE_TTL_SECONDS]
+            for entry in entries:
+                distance = distance_km(lat, lon, entry["lat"], entry["lon"])
+                if distance <= FORECAST_SHARE_KM and (best_distance is None or distance < best_distance):
+                    best, best_distance = entry, distance
+    return best, best_distance
+
+
+def lookup(lat, lon):
+    """
+    近くの地点で取得済みの天気予報を返す
+
+    Returns:
+        dict | None: フォーマット済みの天気予報。共有できる予報がなければ None
+    """
+    with _lock:
+        entry, distance = _nearest(lat, lon, time.time())
+        if entry is None:
+            _stats["misses"] += 1
+            return None
+        _stats["hits"] += 1
+        if distance > 0:
+            _stats["shared"] += 1
+        return entry["forecast"]
+
+
+def store(lat, lon, forecast):
+    with _lock:
+        _cells.setdefault(_cell(lat, lon), []).append({
+            "lat": lat,
+            "lon": lon,
+            "fetched_at": time.time(),
+            "forecast": forecast,
+        })
+
+
+def acquire_fetch_lock(lat, lon, timeout=-1):
+    """
+    同じマスの天気予報を同時に取得しないためのロックを取得する。
+    取得中に来た近くの地点のリクエストは、取得が終わるのを待ってからキャッシュを使う。
+
+    ロックを持っているリクエストは外部APIのトークン待ちをすることがあるので
+    (バックグラウンドの取得は最大60秒)、対話的なリクエストは timeout 秒で待つのをやめる。
+
+    Returns:
+        threading.Lock | None: 取得したロック (呼び出し側で release する)。タイムアウトした場合は None
+    """
+    with _lock:
+        lock = _fetch_locks.setdefault(_cell(lat, lon), threading.Lock())
+    if lock.acquire(timeout=timeout):
+        return lock
+    with _lock:
+        _stats["wait_timeouts"] += 1
+    return None
+
+
+def stats():
+    with _lock:
+        return {
+            **_stats,
+            "points": sum(len(entries) for entries in _cells.values()),
+            "share_km": FORECAST_SHARE_KM,
+            "ttl_seconds": FORECAST_CACHE_TTL_SECONDS,
+        }
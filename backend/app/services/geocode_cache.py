@@ -0,0 +1,92 @@
+import os
+import json
+import time
+import threading
+import unicodedata
+
+CACHE_PATH = os.getenv("GEOCODE_CACHE_PATH", "data/geocode_cache.json")
+# 見つかった住所の有効期限 (既定: 90日)
+POSITIVE_TTL_SECONDS = int(os.getenv("GEOCODE_CACHE_TTL_SECONDS", str(90 * 24 * 3600)))
+# 見つからなかった住所の有効期限 (既定: 1日)
+NEGATIVE_TTL_SECONDS = int(os.getenv("GEOCODE_NEGATIVE_TTL_SECONDS", str(24 * 3600)))
+
+# キャッシュに存在しないことを表す値 (None は「住所が見つからない」を表す)
+MISS = object()
+
+_lock = threading.Lock()
+_entries = None
+
+
+def normalize_key(prefecture, city):
+    """
+    県名と市名からキャッシュキーを作成する (全角/半角・空白の揺れを吸収)
+    """
+    address = f"{prefecture}{city}"
+    address = unicodedata.normalize("NFKC", address)
+    return "".join(address.split())
+
+
+def _load():
+    global _entries
+    if _entries is not None:
+        return
+    try:
+        with open(CACHE_PATH, "r", encoding="utf-8") as f:
+            _entries = json.load(f)
+    except FileNotFoundError:
+        _entries = {}
+    except Exception as e:
+        print(f"ジオコードキャッシュの読み込みに失敗しました: {e}")
+        _entries = {}
+
+
+def _save():
+    # 書き込み途中で落ちてもキャッシュが壊れないように一時ファイル経由で置き換える
+    tmp_path = f"{CACHE_PATH}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(_entries, f, ensure_ascii=False)
+        os.replace(tmp_path, CACHE_PATH)
+    except Exception as e:
+        print(f"ジオコードキャッシュの保存に失敗しました: {e}")
+
+
+def get(prefecture, city):
+    """
+    キャッシュから緯度経度を取得する
+
+    Returns:
+        tuple | None | MISS: (緯度, 経度)、見つからない住所として記録済みなら None、
+        キャッシュにない(または期限切れ)なら MISS
+    """
+    key = normalize_key(prefecture, city)
+    with _lock:
+        _load()
+        entry = _entries.get(key)
+        if entry is None:
+            return MISS
+        if entry["expires_at"] < time.time():
+            del _entries[key]
+            return MISS
+        if entry["coords"] is None:
+            return None
+        return tuple(entry["coords"])
+
+
+def put(prefecture, city, coords):
+    """
+    緯度経度をキャッシュに保存する。coords が None の場合は「見つからない」ことを記録する。
+    """
+    key = normalize_key(prefecture, city)
+    ttl = POSITIVE_TTL_SECONDS if coords is not None else NEGATIVE_TTL_SECONDS
+    now = time.time()
+    with _lock:
+        _load()
+        # 期限切れのエントリは保存のついでに掃除する
+        for expired_key in [k for k, v in _entries.items() if v["expires_at"] < now]:
+            del _entries[expired_key]
+        _entries[key] = {
+            "coords": list(coords) if coords is not None else None,
+            "expires_at": now + ttl,
+        }
+        _save()
@@ -0,0 +1,80 @@
+import os
+import time
+import threading
+
+# 起動時に購読中の場所の天気予報を取得しておく
+WARMUP_PREFETCH = os.getenv("WARMUP_PREFETCH", "1") == "1"
+
+_lock = threading.Lock()
+_checks = {}  # 名前 -> {"ok", "required", "detail", "seconds"}
+_warmup_done = False      # 必須の準備が終わったかどうか
+_optional_done = False    # 必須でない準備 (外部APIへの接続確認、アセット・予報の事前取得) も終わったかどうか
+_started_at = time.time()
+_warmup_thread = None
+
+
+def record(name, ok, detail="", required=True, seconds=None):
+    """準備状況の確認結果を記録する (required=False の確認は失敗しても準備完了を妨げない)"""
+    with _lock:
+        _checks[name] = {"ok": ok, "required": required, "detail": detail, "seconds": seconds}
+
+
+def is_ready():
+    with _lock:
+        return _warmup_done and all(check["ok"] for check in _checks.values() if check["required"])
+
+
+def status():
+    with _lock:
+        checks = {name: dict(check) for name, check in _checks.items()}
+        warmup_done = _warmup_done
+        optional_done = _optional_done
+    return {
+        "ready": is_ready(),
+        "warmup_done": warmup_done,
+        "optional_warmup_done": optional_done,
+        "uptime_seconds": round(time.time() - _started_at, 1),
+        "checks": checks,
+    }
+
+
+def _run_step(name, step, required):
+    started = time.monotonic()
+    try:
+        detail = step()
+        record(name, True, detail or "", required, round(time.monotonic() - started, 3))
+    except Exception as e:
+        print(f"起動時の準備に失敗しました ({name}): {e}")
+        record(name, False, str(e), required, round(time.monotonic() - started, 3))
+
+
+def _run_warmup(steps):
+    global _warmup_done, _optional_done
+    # 必須の準備が終わった時点で準備完了にし、時間のかかる必須でない準備 (フォントの取得など) は
+    # そのあとに実行する (ヘルスチェックが必須でない準備を待たないように)
+    for name, step, required in steps:
+        if required:
+            _run_step(name, step, required)
+    with _lock:
+        _warmup_done = True
+    print("起動時の準備が完了しました" if is_ready() else "起動時の準備に失敗した項目があります")
+
+    for name, step, required in steps:
+        if not required:
+            _run_step(name, step, required)
+    with _lock:
+        _optional_done = True
+
+
+def start_warmup(steps):
+    """
+    起動時の準備をバックグラウンドで実行する。必須の準備が終わるまで is_ready() は False を返す。
+    必須でない準備は、必須の準備が終わったあとに順に実行する。
+
+    Args:
+        steps: [(名前, 関数, 必須かどうか), ...]。関数は結果の説明(文字列)を返すか、失敗時に例外を投げる
+    """
+    global _warmup_thread
+    if _warmup_thread is None:
+        _warmup_thread = threading.Thread(target=_run_warmup, args=(steps,), daemon=True, name="warmup")
+        _warmup_thread.start()
@@ -0,0 +1,202 @@
+import os
+import math
+import time
+import uuid
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 服装提案を生成するワーカー数 (Geminiへの同時リクエスト数の上限にもなる)
+JOBS_MAX_WORKERS = int(os.getenv("JOBS_MAX_WORKERS", "4"))
+# 実行待ちにできるジョブ数。超えた場合は受け付けない
+JOBS_MAX_QUEUED = int(os.getenv("JOBS_MAX_QUEUED", "64"))
+# 終了したジョブの結果を保持する期間 (秒)
+JOBS_RESULT_TTL_SECONDS = int(os.getenv("JOBS_RESULT_TTL_SECONDS", "300"))
+# 実行待ちでいられる最大時間 (秒)。この時間内に開始できる見込みのないジョブは受け付けず、
+# 超えたジョブは実行せずに失敗させる (クライアントを待たせてから失敗させない)
+JOBS_QUEUE_DEADLINE_SECONDS = float(os.getenv("JOBS_QUEUE_DEADLINE_SECONDS", "30"))
+_EWMA_ALPHA = 0.2
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+_FINISHED = (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED)
+
+
+class JobQueueFullError(Exception):
+    """実行待ちのジョブが JOBS_MAX_QUEUED に達しているか、期限内に開始できる見込みがない場合の例外"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after  # 再試行までの目安 (秒)
+
+
+class JobExpiredError(Exception):
+    """実行待ちのまま JOBS_QUEUE_DEADLINE_SECONDS が過ぎたジョブの例外 (describe_error に渡す)"""
+
+
+_lock = threading.Lock()
+_jobs = {}  # ジョブID -> ジョブ (dict)
+_executor = ThreadPoolExecutor(max_workers=JOBS_MAX_WORKERS, thread_name_prefix="job")
+_stats = {"submitted": 0, "rejected": 0, "expired": 0, "done": 0, "failed": 0, "cancelled": 0}
+_service_ewma = None  # 1ジョブの実行時間の指数移動平均 (秒)
+
+
+def _prune(now):
+    expired = [job_id for job_id, job in _jobs.items()
+               if job["finished_at"] is not None and now - job["finished_at"] > JOBS_RESULT_TTL_SECONDS]
+    for job_id in expired:
+        del _jobs[job_id]
+
+
+def _finish(job, status, result=None, error=None):
+    with _lock:
+        if job["status"] in _FINISHED:
+            return
+        job["status"] = status
+        job["result"] = result
+        job["error"] = error
+        job["finished_at"] = time.time()
+        _stats[status] += 1
+
+
+def _estimated_wait():
+    """新しいジョブが実行を始めるまでの見込み時間 (秒, _lock を持って呼ぶ)"""
+    running = sum(1 for job in _jobs.values() if job["status"] == STATUS_RUNNING)
+    queued = sum(1 for job in _jobs.values() if job["status"] == STATUS_QUEUED)
+    if _service_ewma is None or running + queued < JOBS_MAX_WORKERS:
+        return 0.0
+    return (queued // JOBS_MAX_WORKERS + 1) * _service_ewma
+
+
+def _record_service_time(elapsed):
+    global _service_ewma
+    with _lock:
+        _service_ewma = elapsed if _service_ewma is None else \
+            _EWMA_ALPHA * elapsed + (1 - _EWMA_ALPHA) * _service_ewma
+
+
+def _run(job, fn, args, describe_error):
+    with _lock:
+        if job["status"] != STATUS_QUEUED:
+            return
+        waited = time.time() - job["created_at"]
+        expired = waited > JOBS_QUEUE_DEADLINE_SECONDS
+        if expired:
+            _stats["expired"] += 1
+        else:
+            job["status"] = STATUS_RUNNING
+            job["started_at"] = time.time()
+    if expired:
+        _finish(job, STATUS_FAILED, error=describe_error(JobExpiredError(f"waited {waited:.1f}s in the queue")))
+        return
+    started = time.monotonic()
+    try:
+        result = fn(*args)
+    except Exception as e:
+        _finish(job, STATUS_FAILED, error=describe_error(e))
+        return
+    finally:
+        _record_service_time(time.monotonic() - started)
+    # 実行中にキャンセルされたジョブの結果は捨てる
+    _finish(job, STATUS_DONE, result=result)
+
+
+def submit(fn, args, describe_error):
+    """
+    ジョブを登録する
+
+    Args:
+        fn: ワーカースレッドで実行する関数。戻り値がジョブの結果になる
+        args: fn に渡す引数 (tuple)
+        describe_error: 例外を結果用の dict に変換する関数
+
+    Returns:
+        dict: 登録したジョブの状態 (to_dict() の形式)
+
+    Raises:
+        JobQueueFullError: 実行待ちのジョブが多すぎるか、JOBS_QUEUE_DEADLINE_SECONDS 以内に開始できない見込みの場合
+    """
+    now = time.time()
+    with _lock:
+        _prune(now)
+        queued = sum(1 for job in _jobs.values() if job["status"] == STATUS_QUEUED)
+        estimated_wait = _estimated_wait()
+        if queued >= JOBS_MAX_QUEUED:
+            _stats["rejected"] += 1
+            raise JobQueueFullError(f"{queued} jobs are waiting", max(1, math.ceil(estimated_wait)))
+        if estimated_wait > JOBS_QUEUE_DEADLINE_SECONDS:
+            _stats["rejected"] += 1
+            raise JobQueueFullError(f"estimated wait {estimated_wait:.1f}s exceeds the deadline", math.ceil(estimated_wait - JOBS_QUEUE_DEADLINE_SECONDS) + 1)
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": STATUS_QUEUED,
+            "result": None,
+            "error": None,
+            "created_at": now,
+            "started_at": None,
+            "finished_at": None,
+        }
+        _jobs[job["id"]] = job
+        _stats["submitted"] += 1
+    job["future"] = _executor.submit(_run, job, fn, args, describe_error)
+    return to_dict(job)
+
+
+def to_dict(job):
+    with _lock:
+        return {key: value for key, value in job.items() if key != "future"}
+
+
+def get(job_id):
+    """ジョブを返す。存在しない(または期限切れの)場合は None"""
+    with _lock:
+        _prune(time.time())
+        return _jobs.get(job_id)
+
+
+async def wait(job, timeout):
+    """ジョブが終了するか timeout 秒が経つまで待つ (ワーカーは止めない)"""
+    future = job.get("future")
+    if future is None or timeout <= 0:
+        return
+    try:
+        await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+    except asyncio.TimeoutError:
+        # クライアントの切断 (CancelledError) はそのまま伝える
+        pass
+
+
+def cancel(job):
+    """
+    ジョブをキャンセルする。実行待ちならワーカーで実行されず、実行中なら結果を破棄する。
+
+    Returns:
+        bool: キャンセルした場合は True (すでに終了していた場合は False)
+    """
+    with _lock:
+        if job["status"] in _FINISHED:
+            return False
+    future = job.get("future")
+    if future is not None:
+        future.cancel()
+    _finish(job, STATUS_CANCELLED)
+    return True
+
+
+def stats():
+    with _lock:
+        by_status = {}
+        for job in _jobs.values():
+            by_status[job["status"]] = by_status.get(job["status"], 0) + 1
+        return {
+            **_stats,
+            "current": by_status,
+            "max_workers": JOBS_MAX_WORKERS,
+            "max_queued": JOBS_MAX_QUEUED,
+            "queue_deadline_seconds": JOBS_QUEUE_DEADLINE_SECONDS,
+            "service_ewma_seconds": round(_service_ewma, 3) if _service_ewma is not None else None,
+            "estimated_wait_seconds": round(_estimated_wait(), 3),
+        }
@@ -0,0 +1,177 @@
+import os
+import time
+import hashlib
+import datetime
+import threading
+import google.generativeai as genai
+
+# 使用するモデル (品質の高い順)。負荷が高いときは後ろのモデルを使う
+GEMINI_MODELS = [name.strip() for name in os.getenv("GEMINI_MODELS", "gemini-2.0-flash-lite").split(",") if name.strip()]
+# 出力トークン数の上限 (長い順)。負荷が高いときは後ろの上限を使う
+GEMINI_MAX_OUTPUT_TOKENS = [int(value) for value in os.getenv("GEMINI_MAX_OUTPUT_TOKENS", "2048,1024,512").split(",") if value.strip()]
+# 同時に生成中のリクエストがこの数を超えるごとに1段階軽くする
+ROUTER_QUEUE_STEP = int(os.getenv("ROUTER_QUEUE_STEP", "4"))
+# 最近の応答時間(指数移動平均)がこの秒数を超えるごとに1段階軽くする
+ROUTER_LATENCY_TARGET_SECONDS = float(os.getenv("ROUTER_LATENCY_TARGET_SECONDS", "6"))
+_EWMA_ALPHA = 0.2
+# 1 の場合、プロンプトの固定の指示を Gemini 側にキャッシュする (cached content)。
+# 対応していないモデルや、指示が短すぎてキャッシュできない場合は system_instruction で代用する
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "0") == "1"
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+_MAX_MODELS = 32
+
+_LEVELS = max(len(GEMINI_MODELS), len(GEMINI_MAX_OUTPUT_TOKENS))
+
+_lock = threading.Lock()
+# モデルの作成 (cached content の作成を含む) は時間がかかるので、負荷の集計とは別のロックにする
+_models_lock = threading.Lock()
+_models = {}  # (モデル名, 指示のハッシュ) -> {"model", "expires_at"}
+_uncacheable = set()  # cached content を作れなかった (モデル名, 指示のハッシュ)
+_in_flight = 0
+_latency_ewma = None
+_stats = {"routes": {}, "reasons": {}, "errors": 0, "context_caches": 0}
+
+
+def _create_model(name, system_instruction, key):
+    """
+    モデルを作成する。
+
+    Returns:
+        tuple: (genai.GenerativeModel, 作り直す時刻 (time.monotonic()) または None)
+    """
+    if not system_instruction:
+        return genai.GenerativeModel(name), None
+    if GEMINI_CONTEXT_CACHE and key not in _uncacheable:
+        try:
+            from google.generativeai import caching
+            cached_content = caching.CachedContent.create(
+                model=name,
+                system_instruction=system_instruction,
+                ttl=datetime.timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL_SECONDS),
+            )
+            _stats["context_caches"] += 1
+            # 期限切れの直前に作り直す
+            return genai.GenerativeModel.from_cached_content(cached_content=cached_content), \
+                time.monotonic() + GEMINI_CONTEXT_CACHE_TTL_SECONDS * 0.9
+        except Exception as e:
+            print(f"プロンプトの固定部分をキャッシュできませんでした ({name}): {e}")
+            _uncacheable.add(key)
+    return genai.GenerativeModel(name, system_instruction=system_instruction), None
+
+
+def _model(name, system_instruction=None):
+    """
+    system_instruction (プロンプトの固定の指示) ごとにモデルを作成して使い回す。
+    テンプレートが変わると指示のハッシュが変わるので、新しいモデルが作られる。
+    """
+    instruction_hash = hashlib.sha1((system_instruction or "").encode("utf-8")).hexdigest()[:16]
+    key = (name, instruction_hash)
+    with _models_lock:
+        entry = _models.get(key)
+        if entry is not None and (entry["expires_at"] is None or time.monotonic() < entry["expires_at"]):
+            return entry["model"]
+        model, expires_at = _create_model(name, system_instruction, key)
+        _models.pop(key, None)
+        if len(_models) >= _MAX_MODELS:
+            # 最も古いモデルを捨てる (dictは挿入順を保持する)
+            del _models[next(iter(_models))]
+        _models[key] = {"model": model, "expires_at": expires_at}
+        return model
+
+
+def warm_up(system_instructions=()):
+    """設定されたすべてのモデルを、プロンプトの固定の指示ごとに作成しておく"""
+    for name in GEMINI_MODELS:
+        _model(name)
+        for system_instruction in system_instructions:
+            _model(name, system_instruction)
+    return ", ".join(GEMINI_MODELS)
+
+
+def choose(quick=False, min_output_tokens=None):
+    """
+    現在の負荷に応じてモデルと出力トークン数の上限を選ぶ
+
+    Args:
+        quick (bool): 短く速い回答を求めるリクエストなら True (最も軽い段階を使う)
+        min_output_tokens (int): 出力トークン数の下限 (JSONなど、途中で切れると困る出力用)
+
+    Returns:
+        dict: {"model", "max_output_tokens", "level", "reason"}
+    """
+    with _lock:
+        queue_level = _in_flight // ROUTER_QUEUE_STEP if ROUTER_QUEUE_STEP > 0 else 0
+        latency_level = 0
+        if _latency_ewma is not None and ROUTER_LATENCY_TARGET_SECONDS > 0:
+            latency_level = int(_latency_ewma // ROUTER_LATENCY_TARGET_SECONDS)
+
+    if quick:
+        level, reason = _LEVELS - 1, "quick"
+    elif queue_level == 0 and latency_level == 0:
+        level, reason = 0, "normal"
+    elif queue_level >= latency_level:
+        level, reason = queue_level, "queue"
+    else:
+        level, reason = latency_level, "latency"
+    level = min(level, _LEVELS - 1)
+
+    max_output_tokens = GEMINI_MAX_OUTPUT_TOKENS[min(level, len(GEMINI_MAX_OUTPUT_TOKENS) - 1)]
+    if min_output_tokens is not None:
+        max_output_tokens = max(max_output_tokens, min_output_tokens)
+    return {
+        "model": GEMINI_MODELS[min(level, len(GEMINI_MODELS) - 1)],
+        "max_output_tokens": max_output_tokens,
+        "level": level,
+        "reason": reason,
+    }
+
+
+def brevity_instruction(route):
+    """軽い段階を選んだときにプロンプトの末尾に付ける指示 (出力が途中で切れないようにする)"""
+    if route["level"] == 0:
+        return ""
+    return f"\n\n混雑しているため、回答は要点だけに絞り、{route['max_output_tokens'] // 2}文字以内で簡潔にまとめてください。"
+
+
+def generate(route, prompt, generation_config=None, system_instruction=None):
+    """
+    choose() で選んだモデルで生成し、応答時間を記録する。
+    system_instruction はモデル側に保持されるので、prompt には可変部分だけを渡す。
+    """
+    global _in_flight, _latency_ewma
+    config = dict(generation_config or {})
+    config["max_output_tokens"] = route["max_output_tokens"]
+
+    with _lock:
+        _in_flight += 1
+        route_key = f"{route['model']}:{route['max_output_tokens']}"
+        _stats["routes"][route_key] = _stats["routes"].get(route_key, 0) + 1
+        _stats["reasons"][route["reason"]] = _stats["reasons"].get(route["reason"], 0) + 1
+    started = time.monotonic()
+    try:
+        return _model(route["model"], system_instruction).generate_content(prompt, generation_config=config)
+    except Exception:
+        with _lock:
+            _stats["errors"] += 1
+        raise
+    finally:
+        elapsed = time.monotonic() - started
+        with _lock:
+            _in_flight -= 1
+            _latency_ewma = elapsed if _latency_ewma is None else \
+                _EWMA_ALPHA * elapsed + (1 - _EWMA_ALPHA) * _latency_ewma
+
+
+def stats():
+    with _lock:
+        return {
+            "in_flight": _in_flight,
+            "latency_ewma_seconds": round(_latency_ewma, 3) if _latency_ewma is not None else None,
+            "routes": dict(_stats["routes"]),
+            "reasons": dict(_stats["reasons"]),
+            "errors": _stats["errors"],
+            "context_caches": _stats["context_caches"],
+            "context_cache_enabled": GEMINI_CONTEXT_CACHE,
+            "models": GEMINI_MODELS,
+            "max_output_tokens": GEMINI_MAX_OUTPUT_TOKENS,
+        }
@@ -0,0 +1,176 @@
+import os
+import re
+import hmac
+import asyncio
+import time
+import datetime
+import functools
+import contextvars
+
+# pyinstrument は任意の依存関係 (サンプリング方式で低オーバーヘッド)
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:
+    Profiler = None
+
+# 全リクエストをプロファイルする場合は PROFILE_ALL=1
+PROFILE_ALL = os.getenv("PROFILE_ALL", "0") == "1"
+# リクエスト単位で有効にするヘッダ (例: X-Profile: 1)
+PROFILE_HEADER = b"x-profile"
+# ヘッダの値がこのトークンと一致したときだけ有効にする
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+# トークンなしでヘッダ (X-Profile: 1) を受け付ける場合は PROFILE_ENABLED=1 (開発環境用)。
+# どちらも設定されていなければヘッダは無視する (任意のクライアントにプロファイルさせない)
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "0") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "data/profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))  # サンプリング間隔 (秒)
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+PROFILE_MAX_TOTAL_BYTES = int(os.getenv("PROFILE_MAX_TOTAL_MB", "50")) * 1024 * 1024
+# プロファイルしないパス。接続し続けるストリーム (SSE) は切断まで記録が増え続け、保存もされないため
+_UNPROFILED_PATHS = ("/events",)
+
+
+# プロファイル中のリクエストの情報 (スレッドプールで実行される処理にも引き継がれる)
+_current = contextvars.ContextVar("profiled_request", default=None)
+
+
+def profile_in_thread(fn):
+    """
+    同期関数のハンドラ (スレッドプールで実行される) を、実行するスレッドでプロファイルする。
+
+    pyinstrument は start() したスレッドしかサンプリングしないため、ミドルウェアのプロファイラ
+    (イベントループのスレッド) にはスレッドプールで待っている1フレームしか残らない。
+    このデコレータを付けたハンドラは、ワーカースレッドでのプロファイルも保存する。
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        request_profile = _current.get()
+        if request_profile is None:
+            return fn(*args, **kwargs)
+        profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="disabled")
+        profiler.start()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.stop()
+            request_profile["thread_profilers"].append(profiler)
+    return wrapper
+
+
+def _should_profile(scope):
+    if Profiler is None or scope.get("path") in _UNPROFILED_PATHS:
+        return False
+    if PROFILE_ALL:
+        return True
+    for name, value in scope.get("headers", []):
+        if name == PROFILE_HEADER:
+            if PROFILE_TOKEN:
+                # str 同士の compare_digest は非ASCII文字で TypeError になるので、バイト列で比べる
+                return hmac.compare_digest(value, PROFILE_TOKEN.encode("utf-8"))
+            return PROFILE_ENABLED and value.decode("latin-1").lower() in ("1", "true", "yes")
+    return False
+
+
+def _enforce_retention():
+    """保存数と合計サイズの上限を超えた古いプロファイルを削除する"""
+    files = []
+    for name in os.listdir(PROFILE_DIR):
+        path = os.path.join(PROFILE_DIR, name)
+        files.append((os.path.getmtime(path), os.path.getsize(path), path))
+    files.sort()
+
+    total = sum(size for _, size, _ in files)
+    while files and (len(files) > PROFILE_MAX_FILES or total > PROFILE_MAX_TOTAL_BYTES):
+        _, size, path = files.pop(0)
+        os.remove(path)
+        total -= size
+
+
+def _save(profiler, scope, duration, suffix=""):
+    """プロファイル結果を speedscope 形式 (フレームグラフ表示に対応) で保存する"""
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        now = datetime.datetime.utcnow() + datetime.timedelta(hours=9)
+        route = re.sub(r"[^0-9A-Za-z]+", "_", scope.get("path", "")).strip("_") or "root"
+        filename = f"{now.strftime('%Y%m%dT%H%M%S_%f')}_{route}_{int(duration * 1000)}ms{suffix}.speedscope.json"
+        output = profiler.output(SpeedscopeRenderer())
+        if len(output.encode("utf-8")) > PROFILE_MAX_TOTAL_BYTES:
+            print(f"プロファイルが大きすぎるため保存しませんでした: {filename}")
+            return None
+        with open(os.path.join(PROFILE_DIR, filename), "w", encoding="utf-8") as f:
+            f.write(output)
+        _enforce_retention()
+        return filename
+    except Exception as e:
+        print(f"プロファイルの保存に失敗しました: {e}")
+        return None
+
+
+def _save_all(profiler, request_profile, scope, duration):
+    """
+    イベントループとワーカースレッドのプロファイルを保存し、保存したファイル名を返す。
+    speedscope 形式への変換と書き込みは重いので、スレッドで実行する (_save_in_thread)。
+    """
+    filenames = [_save(profiler, scope, duration)]
+    for i, thread_profiler in enumerate(request_profile["thread_profilers"]):
+        filenames.append(_save(thread_profiler, scope, duration, suffix=f"_thread{i}"))
+    return [filename for filename in filenames if filename]
+
+
+async def _save_in_thread(profiler, request_profile, scope, duration):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _save_all, profiler, request_profile, scope, duration)
+
+
+class ProfilingMiddleware:
+    """
+    X-Profile ヘッダ付きのリクエスト (PROFILE_ALL=1 なら全リクエスト。/events は除く) をプロファイルし、
+    結果を data/profiles/ に保存するASGIミドルウェア。
+    保存したファイル名はレスポンスの X-Profile-File ヘッダで (複数ある場合はカンマ区切りで) 返す。
+
+    スレッドプールで実行される同期関数のハンドラは、profile_in_thread を付けたものだけ
+    ワーカースレッドの処理も記録される。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="enabled")
+        request_profile = {"thread_profilers": []}
+        token = _current.set(request_profile)
+        started = time.perf_counter()
+        profiler.start()
+        response_start = None
+
+        # レスポンスヘッダにファイル名を載せるため、本体より先にプロファイルを保存する
+        async def send_wrapper(message):
+            nonlocal response_start
+            if message["type"] == "http.response.start":
+                response_start = message
+                return
+            if response_start is not None and message["type"] == "http.response.body" and not message.get("more_body", False):
+                profiler.stop()
+                filenames = await _save_in_thread(profiler, request_profile, scope, time.perf_counter() - started)
+                if filenames:
+                    response_start["headers"] = list(response_start.get("headers", [])) + [(b"x-profile-file", ",".join(filenames).encode("latin-1"))]
+                await send(response_start)
+                response_start = None
+            elif response_start is not None:
+                # ストリーミングレスポンスはプロファイル終了を待たずに送る
+                await send(response_start)
+                response_start = None
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            if profiler.is_running:
+                profiler.stop()
+                await _save_in_thread(profiler, request_profile, scope, time.perf_counter() - started)
@@ -0,0 +1,49 @@
+import os
+import threading
+
+# 固定の指示と、リクエストごとに変わる部分 (現在時刻・天気・衣類データ) の境目。
+# テンプレートの最初の見出し行より前を固定の指示 (system_instruction) として扱う
+SECTION_MARKER = "## "
+
+_lock = threading.Lock()
+_templates = {}  # パス -> {"mtime", "instruction", "body"}
+
+
+def split(text):
+    """
+    テンプレートを (固定の指示, 可変部分) に分ける。見出しがなければ全体を可変部分とする。
+    """
+    lines = text.splitlines(keepends=True)
+    for index, line in enumerate(lines):
+        if line.startswith(SECTION_MARKER):
+            return "".join(lines[:index]).strip(), "".join(lines[index:])
+    return "", text
+
+
+def load(template_path):
+    """
+    テンプレートを読み込む。ファイルが更新されていれば読み込み直す。
+
+    Returns:
+        tuple: (固定の指示, 可変部分のテンプレート)
+    """
+    mtime = os.stat(template_path).st_mtime
+    with _lock:
+        cached = _templates.get(template_path)
+        if cached is not None and cached["mtime"] == mtime:
+            return cached["instruction"], cached["body"]
+
+    with open(template_path, "r", encoding="utf-8") as f:
+        instruction, body = split(f.read())
+    with _lock:
+        _templates[template_path] = {"mtime": mtime, "instruction": instruction, "body": body}
+    return instruction, body
+
+
+def render(template_path, **values):
+    """
+    Returns:
+        tuple: (固定の指示, 変数を埋め込んだ可変部分)
+    """
+    instruction, body = load(template_path)
+    return instruction, body.format(**values)
@@ -0,0 +1,132 @@
+import os
+import json
+import asyncio
+import threading
+
+# 接続中のクライアントが見ている場所の予報を確認する間隔 (秒)
+PUSH_CHECK_SECONDS = int(os.getenv("PUSH_CHECK_SECONDS", "600"))
+# 接続を維持するためのコメントを送る間隔 (秒)
+PUSH_HEARTBEAT_SECONDS = 15
+# クライアントごとに溜めておく未送信イベントの上限
+_QUEUE_SIZE = 8
+# 提案を作成したときの予報の要約を覚えておく場所の数
+_MAX_ADVICE_PROFILES = 256
+
+_listeners = {}   # (場所, 形式) -> {asyncio.Queue, ...}
+_baselines = {}   # (場所, 形式) -> 最後に提案を作成・配信したときの予報の要約
+_advice_profiles_lock = threading.Lock()
+_advice_profiles = {}  # (場所, 形式) -> 最後に作成した提案の元になった予報の要約 (接続の有無によらない)
+_watcher_task = None
+_loop = None
+
+
+def _format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _set_baseline(key, profile):
+    if key in _listeners:
+        _baselines[key] = profile
+
+
+def note_advice(name, advice_format, profile):
+    """
+    提案を作成した(またはダイジェストから返した)ときの予報の要約を記録する。
+    クライアントが持っている提案の元になった予報を、変化を判定する基準にするため。
+    別のスレッドからも呼べる。
+    """
+    key = (name, advice_format)
+    with _advice_profiles_lock:
+        _advice_profiles.pop(key, None)
+        if len(_advice_profiles) >= _MAX_ADVICE_PROFILES:
+            # 最も古い場所を捨てる (dictは挿入順を保持する)
+            del _advice_profiles[next(iter(_advice_profiles))]
+        _advice_profiles[key] = profile
+    if _loop is not None:
+        _loop.call_soon_threadsafe(_set_baseline, key, profile)
+
+
+def _publish(name, advice_format, response, profile=None):
+    key = (name, advice_format)
+    if profile is not None:
+        _baselines[key] = profile
+    message = _format_event("advice", response)
+    for queue in list(_listeners.get(key, ())):
+        if queue.full():
+            # 受信が追いつかないクライアントには最新のイベントだけを残す
+            queue.get_nowait()
+        queue.put_nowait(message)
+
+
+def publish(name, advice_format, response, profile=None):
+    """
+    指定した場所を見ているクライアントに、新しい服装提案を配信する。
+    ダイジェストのスケジューラなど、別のスレッドからも呼べる。
+    """
+    if _loop is None or (name, advice_format) not in _listeners:
+        return
+    _loop.call_soon_threadsafe(_publish, name, advice_format, response, profile)
+
+
+async def stream(name, advice_format, is_disconnected):
+    """
+    Server-Sent Events のストリーム。予報が大きく変わったときに "advice" イベントを送る。
+    """
+    key = (name, advice_format)
+    queue = asyncio.Queue(maxsize=_QUEUE_SIZE)
+    _listeners.setdefault(key, set()).add(queue)
+    if key not in _baselines:
+        # 接続前に作成した提案の元になった予報を基準にする
+        with _advice_profiles_lock:
+            profile = _advice_profiles.get(key)
+        if profile is not None:
+            _baselines[key] = profile
+    try:
+        yield ": connected\n\n"
+        while not await is_disconnected():
+            try:
+                message = await asyncio.wait_for(queue.get(), timeout=PUSH_HEARTBEAT_SECONDS)
+                yield message
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+    finally:
+        listeners = _listeners.get(key)
+        if listeners is not None:
+            listeners.discard(queue)
+            if not listeners:
+                del _listeners[key]
+                _baselines.pop(key, None)
+
+
+async def _watch(check_fn):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(PUSH_CHECK_SECONDS)
+        for key in list(_listeners):
+            name, advice_format = key
+            try:
+                # 天気予報の取得と生成はブロッキング処理なのでスレッドで実行する
+                profile, response = await loop.run_in_executor(None, check_fn, name, advice_format, _baselines.get(key))
+            except Exception as e:
+                print(f"予報の変化の確認に失敗しました ({name}): {e}")
+                continue
+            if response is not None:
+                _publish(name, advice_format, response, profile)
+            elif key not in _baselines and key in _listeners:
+                # 作成した提案の記録がない場合 (再起動前に作成した提案など) だけ、今の予報を基準にする
+                _baselines[key] = profile
+
+
+def start_watcher(check_fn):
+    """
+    接続中のクライアントが見ている場所の予報を定期的に確認するタスクを開始する
+
+    Args:
+        check_fn: check_fn(name, advice_format, baseline_profile) -> (profile, response)。
+            baseline_profile から予報が大きく変わっていれば新しい提案を response として返し、
+            変わっていなければ(または baseline_profile が None なら) response は None
+    """
+    global _watcher_task, _loop
+    if _watcher_task is None:
+        _loop = asyncio.get_running_loop()
+        _watcher_task = _loop.create_task(_watch(check_fn))
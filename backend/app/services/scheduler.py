@@ -0,0 +1,193 @@
+import os
+import heapq
+import asyncio
+import itertools
+import threading
+import time
+import datetime
+
+# 優先度 (値が小さいほど優先)
+PRIORITY_INTERACTIVE = 0  # ユーザー操作起点のリクエスト
+PRIORITY_BACKGROUND = 1   # バックグラウンドジョブ (事前取得など)
+
+
+class UpstreamBusyError(Exception):
+    """待ち行列が満杯、または待ち時間の上限を超えた場合の例外"""
+
+
+class QuotaExceededError(Exception):
+    """1日あたりのクォータを使い切った場合の例外"""
+
+
+def _jst_today():
+    utc_now = datetime.datetime.utcnow()
+    return (utc_now + datetime.timedelta(hours=9)).strftime("%Y-%m-%d")
+
+
+class TokenBucket:
+    """
+    外部APIごとのトークンバケット
+
+    rate (トークン/秒) で補充され、capacity までバーストを許可する。
+    トークン待ちのリクエストは優先度順の待ち行列に並び、先頭のリクエストだけがトークンを取得できる。
+    """
+
+    def __init__(self, name, rate, capacity=1, daily_quota=None, max_waiters=32):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.daily_quota = daily_quota
+        self.max_waiters = max_waiters
+
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiters = []  # (priority, seq) のヒープ
+        self._seq = itertools.count()
+
+        # 使用量カウンタ
+        self._quota_day = _jst_today()
+        self._used_today = 0
+        self._total_granted = 0
+        self._total_rejected = 0
+        self._total_wait_seconds = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+
+    def _reset_quota_if_new_day(self):
+        today = _jst_today()
+        if today != self._quota_day:
+            self._quota_day = today
+            self._used_today = 0
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, timeout=10.0):
+        """
+        トークンを1つ取得する。取得できるまでブロックする。
+
+        Args:
+            priority (int): PRIORITY_INTERACTIVE または PRIORITY_BACKGROUND
+            timeout (float): 最大待ち時間 (秒)
+
+        Raises:
+            UpstreamBusyError: 待ち行列が満杯、またはタイムアウトした場合
+            QuotaExceededError: 本日のクォータを使い切っている場合
+        """
+        started = time.monotonic()
+        deadline = started + timeout
+
+        with self._cond:
+            self._reset_quota_if_new_day()
+            if self.daily_quota is not None and self._used_today >= self.daily_quota:
+                self._total_rejected += 1
+                raise QuotaExceededError(f"{self.name}: 本日のクォータ({self.daily_quota}回)を使い切りました")
+            if len(self._waiters) >= self.max_waiters:
+                self._total_rejected += 1
+                raise UpstreamBusyError(f"{self.name}: 待ち行列が満杯です")
+
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    self._refill()
+                    if self._waiters[0] == entry and self._tokens >= 1:
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._total_rejected += 1
+                        raise UpstreamBusyError(f"{self.name}: トークン待ちがタイムアウトしました")
+
+                    # 先頭なら次のトークンが補充されるまで、それ以外は通知が来るまで待つ
+                    if self._waiters[0] == entry:
+                        wait = (1 - self._tokens) / self.rate
+                    else:
+                        wait = remaining
+                    self._cond.wait(min(wait, remaining))
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+            self._tokens -= 1
+            self._used_today += 1
+            self._total_granted += 1
+            self._total_wait_seconds += time.monotonic() - started
+
+    def stats(self):
+        with self._cond:
+            self._reset_quota_if_new_day()
+            return {
+                "rate_per_sec": self.rate,
+                "capacity": self.capacity,
+                "daily_quota": self.daily_quota,
+                "used_today": self._used_today,
+                "remaining_today": None if self.daily_quota is None else max(0, self.daily_quota - self._used_today),
+                "waiting": len(self._waiters),
+                "granted": self._total_granted,
+                "rejected": self._total_rejected,
+                "avg_wait_ms": round(self._total_wait_seconds / self._total_granted * 1000, 1) if self._total_granted else 0.0,
+            }
+
+
+def _optional_int(value):
+    return int(value) if value else None
+
+
+# 外部APIごとのバケット (環境変数で調整可能)
+# Nominatimの利用規約は最大1リクエスト/秒
+_buckets = {
+    "nominatim": TokenBucket(
+        "nominatim",
+        rate=float(os.getenv("NOMINATIM_RATE_PER_SEC", "1")),
+        capacity=int(os.getenv("NOMINATIM_BURST", "1")),
+        daily_quota=_optional_int(os.getenv("NOMINATIM_DAILY_QUOTA")),
+        max_waiters=int(os.getenv("NOMINATIM_MAX_WAITERS", "16")),
+    ),
+    "openweather": TokenBucket(
+        "openweather",
+        rate=float(os.getenv("OPENWEATHER_RATE_PER_SEC", "5")),
+        capacity=int(os.getenv("OPENWEATHER_BURST", "5")),
+        daily_quota=_optional_int(os.getenv("OPENWEATHER_DAILY_QUOTA", "1000")),
+        max_waiters=int(os.getenv("OPENWEATHER_MAX_WAITERS", "32")),
+    ),
+}
+
+
+def _ensure_not_on_event_loop(provider):
+    """
+    トークン待ちは threading.Condition で最大 timeout 秒ブロックするので、イベントループ上で呼ぶと
+    待っている間すべてのリクエストが止まる。async のハンドラからは run_in_threadpool 経由で呼ぶこと。
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return  # スレッドプールやバックグラウンドのスレッドから呼ばれている
+    raise RuntimeError(f"{provider}: イベントループ上でトークンを待とうとしました (run_in_threadpool 経由で呼んでください)")
+
+
+def acquire(provider, priority=PRIORITY_INTERACTIVE, timeout=None):
+    """
+    指定した外部APIのトークンを取得する。ブロッキング処理なので、イベントループ上では呼ばない
+    (同期関数のハンドラやスレッドから呼ぶ)。
+
+    Args:
+        provider (str): "nominatim" または "openweather"
+        priority (int): リクエストの優先度
+        timeout (float): 最大待ち時間 (秒)。省略時は優先度に応じた既定値
+
+    Raises:
+        UpstreamBusyError, QuotaExceededError
+    """
+    _ensure_not_on_event_loop(provider)
+    if timeout is None:
+        timeout = 5.0 if priority == PRIORITY_INTERACTIVE else 60.0
+    _buckets[provider].acquire(priority=priority, timeout=timeout)
+
+
+def get_usage():
+    """外部APIごとの使用量カウンタを返す"""
+    return {name: bucket.stats() for name, bucket in _buckets.items()}
@@ -0,0 +1,47 @@
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+
+# orjson / msgpack は任意の依存関係 (インストールされていなければ標準のJSONを使う)
+try:
+    import orjson
+    from fastapi.responses import ORJSONResponse as FastJSONResponse
+except ImportError:
+    orjson = None
+    FastJSONResponse = JSONResponse
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+
+class MsgPackResponse(Response):
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def render(self, content) -> bytes:
+        return msgpack.packb(content, use_bin_type=True)
+
+
+def wants_msgpack(request: Request):
+    """Acceptヘッダで MessagePack が要求されているか"""
+    if msgpack is None:
+        return False
+    accept = request.headers.get("accept", "")
+    return MSGPACK_MEDIA_TYPE in accept or "application/msgpack" in accept
+
+
+def negotiate(request: Request, content, status_code=200):
+    """
+    Acceptヘッダに応じて MessagePack または JSON のレスポンスを返す
+
+    response_model による検証を通さずにそのまま直列化するので、
+    呼び出し側で content の形を保証すること。
+    """
+    if wants_msgpack(request):
+        response = MsgPackResponse(content, status_code=status_code)
+    else:
+        response = FastJSONResponse(content, status_code=status_code)
+    response.headers["Vary"] = "Accept"  # Accept-Encoding は圧縮ミドルウェアが追加する
+    return response
@@ -0,0 +1,165 @@
+import os
+import re
+import gzip
+import json
+import datetime
+import threading
+
+# off: 何もしない / record: 外部APIの生レスポンスを保存 / replay: 保存済みレスポンスだけで応答
+SNAPSHOT_MODE = os.getenv("SNAPSHOT_MODE", "record").lower()
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "data/snapshots")
+# 1つのキーあたりに保持するスナップショット数
+SNAPSHOT_KEEP_PER_KEY = int(os.getenv("SNAPSHOT_KEEP_PER_KEY", "48"))
+# 全キーを合わせたスナップショットの合計サイズの上限 (MB)。場所が増え続けてもディスクを使い切らないようにする
+SNAPSHOT_MAX_TOTAL_BYTES = int(os.getenv("SNAPSHOT_MAX_TOTAL_MB", "200")) * 1024 * 1024
+# Geminiの出力も記録するかどうか
+SNAPSHOT_RECORD_GEMINI = os.getenv("SNAPSHOT_RECORD_GEMINI", "0") == "1"
+# replayモードで使う時刻 (例: "2025-05-04T16:00")。この時刻以前で最新のスナップショットを返す
+SNAPSHOT_REPLAY_AT = os.getenv("SNAPSHOT_REPLAY_AT", "")
+
+_TIMESTAMP_FORMAT = "%Y%m%dT%H%M%S"
+_lock = threading.Lock()
+_total_bytes = None  # 保存済みスナップショットの合計サイズ (最初の保存時に数える)
+
+
+def is_replay():
+    return SNAPSHOT_MODE == "replay"
+
+
+def is_recording(kind):
+    if SNAPSHOT_MODE != "record":
+        return False
+    if kind == "gemini":
+        return SNAPSHOT_RECORD_GEMINI
+    return True
+
+
+def forecast_key(lat, lon):
+    """緯度経度からスナップショットのキーを作成する (約1km単位に丸める)"""
+    return f"{lat:.2f}_{lon:.2f}"
+
+
+def _key_dir(kind, key):
+    # ファイル名に使えない文字を取り除く (日本語はそのまま使う)
+    safe_key = re.sub(r'[\\/:*?"<>|\s]', "_", key)
+    return os.path.join(SNAPSHOT_DIR, kind, safe_key)
+
+
+def _jst_now():
+    return datetime.datetime.utcnow() + datetime.timedelta(hours=9)
+
+
+def now_jst():
+    """
+    現在時刻(JST)を返す。replayモードで SNAPSHOT_REPLAY_AT が指定されていればその時刻を返す。
+    """
+    if is_replay() and SNAPSHOT_REPLAY_AT:
+        return datetime.datetime.fromisoformat(SNAPSHOT_REPLAY_AT)
+    return _jst_now()
+
+
+def _list_snapshots():
+    """保存済みのスナップショットを古い順に返す: [(ファイル名, パス, サイズ), ...]"""
+    files = []
+    for root, _, names in os.walk(SNAPSHOT_DIR):
+        for name in names:
+            if name.endswith(".json.gz"):
+                path = os.path.join(root, name)
+                files.append((name, path, os.path.getsize(path)))
+    # ファイル名は保存した時刻なので、名前順が古い順になる
+    files.sort()
+    return files
+
+
+def _enforce_total_size():
+    """
+    合計サイズが上限を超えたら、全キーを通して古いスナップショットから削除する (_lock を持って呼ぶ)。
+    各キーの最新のスナップショットは、外部APIが使えないときの代替に使うので残す。
+    """
+    global _total_bytes
+    if _total_bytes is None:
+        _total_bytes = sum(size for _, _, size in _list_snapshots())
+    if _total_bytes <= SNAPSHOT_MAX_TOTAL_BYTES:
+        return
+
+    files = _list_snapshots()
+    _total_bytes = sum(size for _, _, size in files)
+    newest = {}
+    for name, path, _ in files:
+        newest[os.path.dirname(path)] = path
+    # 上限付近で毎回削除し直さないよう、上限の9割まで減らす
+    target = SNAPSHOT_MAX_TOTAL_BYTES * 0.9
+    for _, path, size in files:
+        if _total_bytes <= target:
+            break
+        if newest[os.path.dirname(path)] == path:
+            continue
+        os.remove(path)
+        _total_bytes -= size
+    if _total_bytes > SNAPSHOT_MAX_TOTAL_BYTES:
+        print(f"スナップショットの合計サイズが上限を超えています ({_total_bytes // (1024 * 1024)}MB)")
+
+
+def record(kind, key, payload):
+    """
+    外部APIの生レスポンスを gzip 圧縮して保存する
+
+    Args:
+        kind (str): "forecast", "geocode", "gemini" のいずれか
+        key (str): 場所などを表すキー
+        payload: JSONに変換できるデータ
+    """
+    if not is_recording(kind):
+        return
+    global _total_bytes
+    directory = _key_dir(kind, key)
+    try:
+        with _lock:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{_jst_now().strftime(_TIMESTAMP_FORMAT)}.json.gz")
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            with gzip.open(path, "wt", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False)
+            if _total_bytes is not None:
+                _total_bytes += os.path.getsize(path) - replaced
+
+            # 古いスナップショットを削除する
+            files = sorted(os.listdir(directory))
+            for name in files[:-SNAPSHOT_KEEP_PER_KEY]:
+                old_path = os.path.join(directory, name)
+                size = os.path.getsize(old_path)
+                os.remove(old_path)
+                if _total_bytes is not None:
+                    _total_bytes -= size
+
+            _enforce_total_size()
+    except Exception as e:
+        print(f"スナップショットの保存に失敗しました: {e}")
+
+
+def latest(kind, key):
+    """
+    保存済みのスナップショットのうち最新のものを返す。
+    replayモードで SNAPSHOT_REPLAY_AT が指定されていれば、その時刻以前で最新のものを返す。
+
+    Returns:
+        保存されていたデータ。見つからない場合は None
+    """
+    directory = _key_dir(kind, key)
+    try:
+        files = sorted(name for name in os.listdir(directory) if name.endswith(".json.gz"))
+    except FileNotFoundError:
+        return None
+
+    if is_replay() and SNAPSHOT_REPLAY_AT:
+        limit = datetime.datetime.fromisoformat(SNAPSHOT_REPLAY_AT).strftime(_TIMESTAMP_FORMAT)
+        files = [name for name in files if name[:len(limit)] <= limit]
+    if not files:
+        return None
+
+    try:
+        with gzip.open(os.path.join(directory, files[-1]), "rt", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"スナップショットの読み込みに失敗しました: {e}")
+        return None
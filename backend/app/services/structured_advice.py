@@ -0,0 +1,118 @@
+import json
+import threading
+import services.wardrobe as wardrobe
+
+# 構造化出力のバージョン (ワイヤーフォーマットを変えたら上げる)
+WIRE_VERSION = 1
+
+# 天気パート: 同じ市・同じ予報なら全ユーザーで共有できる
+WEATHER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "hourly": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "time": {"type": "string", "description": "時刻 (例: 09)"},
+                    "note": {"type": "string", "description": "その時間帯の天気の説明 (1文)"},
+                },
+                "required": ["time", "note"],
+            },
+        },
+        "umbrella": {"type": "boolean", "description": "雨具が必要かどうか"},
+    },
+    "required": ["hourly", "umbrella"],
+}
+
+# 服装パート: 天気と衣類データの組み合わせごとに生成する
+OUTFIT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "outfits": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "slot": {"type": "string", "description": "想定される活動時間 (例: 朝の通勤)"},
+                    "item_ids": {"type": "array", "items": {"type": "integer"}, "description": "衣類データのID"},
+                    "comment": {"type": "string", "description": "服装の説明 (1〜2文)"},
+                },
+                "required": ["slot", "item_ids", "comment"],
+            },
+        },
+    },
+    "required": ["outfits"],
+}
+
+_lock = threading.Lock()
+_weather_parts = {}  # (場所, 予報のハッシュ) -> 天気パート
+_outfit_parts = {}   # (場所, 予報のハッシュ, 衣類データのハッシュ) -> 服装パート
+MAX_CACHE_ENTRIES = 256
+
+
+def format_clothes_with_ids(items, candidates):
+    """
+    候補の衣類データを「ID: 名前 (カテゴリ)」の形式にする (IDは /list の並び順)
+    """
+    return "\n".join(f"{item_id}: {items[item_id]['name']} ({wardrobe.category_of(items[item_id])})" for item_id in candidates)
+
+
+def _get(cache, key):
+    with _lock:
+        return cache.get(key)
+
+
+def _put(cache, key, value):
+    with _lock:
+        if len(cache) >= MAX_CACHE_ENTRIES:
+            # 最も古いエントリを捨てる (dictは挿入順を保持する)
+            del cache[next(iter(cache))]
+        cache[key] = value
+
+
+def get_weather_part(location, weather_summary):
+    return _get(_weather_parts, (location, wardrobe.fingerprint(weather_summary)))
+
+
+def put_weather_part(location, weather_summary, part):
+    _put(_weather_parts, (location, wardrobe.fingerprint(weather_summary)), part)
+
+
+def get_outfit_part(location, weather_summary, clothes_list):
+    return _get(_outfit_parts, (location, wardrobe.fingerprint(weather_summary), wardrobe.fingerprint("\n".join(clothes_list))))
+
+
+def put_outfit_part(location, weather_summary, clothes_list, part):
+    _put(_outfit_parts, (location, wardrobe.fingerprint(weather_summary), wardrobe.fingerprint("\n".join(clothes_list))), part)
+
+
+def parse_json(text):
+    """Geminiの出力(JSON文字列)を辞書に変換する"""
+    return json.loads(text)
+
+
+def to_wire(weather_part, outfit_part, clothes_list):
+    """
+    天気パートと服装パートを組み合わせ、短いキーのワイヤーフォーマットに変換する
+
+    {"v": バージョン, "w": [[時刻, 説明], ...], "u": 雨具の要否,
+     "o": [[活動時間, [ID, ...], 説明], ...], "i": {ID: 衣類名}}
+
+    "i" には提案で参照されたIDの衣類名だけを含める。
+    """
+    referenced = {}
+    outfits = []
+    for outfit in outfit_part.get("outfits", []):
+        item_ids = [item_id for item_id in outfit.get("item_ids", []) if 0 <= item_id < len(clothes_list)]
+        for item_id in item_ids:
+            referenced[str(item_id)] = clothes_list[item_id]
+        outfits.append([outfit.get("slot", ""), item_ids, outfit.get("comment", "")])
+
+    return {
+        "v": WIRE_VERSION,
+        "w": [[hour.get("time", ""), hour.get("note", "")] for hour in weather_part.get("hourly", [])],
+        "u": bool(weather_part.get("umbrella", False)),
+        "o": outfits,
+        "i": referenced,
+    }
@@ -0,0 +1,336 @@
+import os
+import csv
+import io
+import json
+import hashlib
+import threading
+
+CLOTHES_PATH = "data/clothes_list.txt"
+
+# 一括インポートで受け付ける最大件数
+IMPORT_MAX_ITEMS = int(os.getenv("WARDROBE_IMPORT_MAX_ITEMS", "10000"))
+MAX_NAME_LENGTH = 100
+
+_lock = threading.Lock()
+
+# /register 画面のカテゴリ
+CATEGORIES = ["トップス", "ボトムス", "アウター", "シューズ", "アクセサリー"]
+
+# プロンプトに渡すカテゴリごとの最大件数
+CANDIDATES_PER_CATEGORY = int(os.getenv("CANDIDATES_PER_CATEGORY", "8"))
+
+# カテゴリが登録されていない服のためのキーワード (先に一致したものを使う)
+_CATEGORY_KEYWORDS = [
+    ("アウター", ["ジャケット", "コート", "ダウン", "ブルゾン", "パーカー", "カーディガン", "ベスト", "レインコート"]),
+    ("ボトムス", ["ズボン", "パンツ", "スラックス", "スカート", "ジーンズ", "ショーツ", "チノ"]),
+    ("シューズ", ["靴", "スニーカー", "ブーツ", "サンダル", "パンプス", "ローファー", "長靴"]),
+    ("アクセサリー", ["帽子", "キャップ", "マフラー", "手袋", "傘", "ネックレス", "ベルト", "バッグ", "ストール"]),
+]
+
+# 服の暖かさの目安 (大きいほど暖かい)
+_WARMTH_KEYWORDS = {
+    "ダウン": 5, "コート": 4, "マフラー": 4, "手袋": 4, "ニット": 3, "セーター": 3, "フリース": 3,
+    "ブーツ": 2, "パーカー": 2, "カーディガン": 2, "ジャケット": 2, "スウェット": 2,
+    "長袖": 1, "ロング": 1, "長ズボン": 1, "デニム": 1, "スラックス": 1, "シャツ": 0,
+    "Tシャツ": -1, "半袖": -2, "半ズボン": -2, "ショート": -2, "サンダル": -3, "タンクトップ": -3,
+}
+
+# 雨の日に役立つ服
+_RAIN_KEYWORDS = ["レイン", "傘", "長靴", "防水", "撥水", "ブーツ"]
+
+
+def parse_line(line):
+    """
+    clothes_list.txt の1行を {"name", "category"} に変換する。
+    行は「名前」または「名前<TAB>カテゴリ」の形式。
+    """
+    name, _, category = line.strip().partition("\t")
+    return {"name": name.strip(), "category": category.strip() or None}
+
+
+def format_line(name, category=None):
+    return f"{name}\t{category}" if category else name
+
+
+def load_items():
+    """
+    服装リストを読み込む
+
+    Returns:
+        list: {"name": 名前, "category": カテゴリ(未登録なら None)} のリスト
+    """
+    try:
+        with open(CLOTHES_PATH, "r", encoding="utf-8") as f:
+            return [parse_line(line) for line in f.readlines() if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def iter_items():
+    """服装リストを1件ずつ読み込む (リスト全体をメモリに載せない)"""
+    try:
+        with open(CLOTHES_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield parse_line(line)
+    except FileNotFoundError:
+        return
+
+
+def names(items):
+    return [item["name"] for item in items]
+
+
+def fingerprint(text):
+    """文字列の短いハッシュ (キャッシュのキーや、内容が変わったかどうかの確認に使う)"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def version(items):
+    """服装リストの内容を表すハッシュ (作成済みの提案やプランが古くなっていないかの確認に使う)"""
+    return fingerprint("\n".join(names(items)))
+
+
+def validate(name, category=None):
+    """
+    登録できる服かどうかを確認する
+
+    Returns:
+        str | None: 登録できない理由。登録できる場合は None
+    """
+    if not name or not name.strip():
+        return "名前が空です"
+    if len(name) > MAX_NAME_LENGTH:
+        return f"名前が長すぎます ({MAX_NAME_LENGTH}文字まで)"
+    if "\t" in name or "\n" in name:
+        return "名前にタブや改行は使えません"
+    if category is not None and category not in CATEGORIES:
+        return f"カテゴリ '{category}' は登録できません"
+    return None
+
+
+def _save(items):
+    # 書き込み途中のファイルが読まれないよう、一時ファイルに書いてから置き換える
+    tmp_path = f"{CLOTHES_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for item in items:
+            f.write(format_line(item["name"], item["category"]) + "\n")
+    os.replace(tmp_path, CLOTHES_PATH)
+
+
+def append(name, category=None, reload=True):
+    """
+    服を1つ追加する
+
+    Returns:
+        list: 追加後の服装リスト (reload=False の場合は読み込まずに None)
+    """
+    with _lock:
+        with open(CLOTHES_PATH, "a", encoding="utf-8") as f:
+            f.write(format_line(name, category) + "\n")
+        return load_items() if reload else None
+
+
+def remove(name):
+    """
+    指定した名前の服を1つ削除する
+
+    Returns:
+        list: 削除後の服装リスト
+
+    Raises:
+        KeyError: 指定した名前の服が見つからない場合
+    """
+    with _lock:
+        items = load_items()
+        for index, item in enumerate(items):
+            if item["name"] == name:
+                del items[index]
+                break
+        else:
+            raise KeyError(name)
+        _save(items)
+        return items
+
+
+def import_items(entries):
+    """
+    服をまとめて追加する。すでに登録されている名前と、entries 内で重複する名前は追加しない。
+    ファイルは1回だけ書き換える。
+
+    Args:
+        entries (list): validate() 済みの {"name", "category"} のリスト
+
+    Returns:
+        tuple: (追加した件数, 重複のため追加しなかった件数, 追加後の服装リスト)
+    """
+    with _lock:
+        items = load_items()
+        known = {item["name"] for item in items}
+        added = 0
+        for entry in entries:
+            if entry["name"] in known:
+                continue
+            known.add(entry["name"])
+            items.append({"name": entry["name"], "category": entry["category"]})
+            added += 1
+        if added:
+            _save(items)
+        return added, len(entries) - added, items
+
+
+def parse_import(lines, import_format):
+    """
+    一括インポートの行を解析・検証する
+
+    Args:
+        lines (list): 改行を除いた行のリスト
+        import_format (str): "csv" (name,category) または "jsonl" ({"name": ..., "category": ...})
+
+    Returns:
+        tuple: (entries, errors)。errors は [{"line": 行番号, "error": 理由}, ...]
+    """
+    rows, errors = [], []
+    if import_format == "csv":
+        for line_no, row in enumerate(csv.reader(lines), start=1):
+            if not row or not any(cell.strip() for cell in row):
+                continue
+            if line_no == 1 and [cell.strip().lower() for cell in row[:2]] in (["name"], ["name", "category"]):
+                continue  # ヘッダ行
+            rows.append((line_no, row[0].strip(), row[1].strip() if len(row) > 1 else ""))
+    else:
+        for line_no, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                errors.append({"line": line_no, "error": f"JSONとして解析できません: {e}"})
+                continue
+            if not isinstance(record, dict):
+                errors.append({"line": line_no, "error": "JSONオブジェクトではありません"})
+                continue
+            if "name" not in record:
+                errors.append({"line": line_no, "error": "name がありません"})
+                continue
+            # 文字列以外 (null・数値・配列など) は文字列に変換せずに不正な行とする
+            name, category = record["name"], record.get("category")
+            if not isinstance(name, str):
+                errors.append({"line": line_no, "error": "name は文字列で指定してください"})
+                continue
+            if category is not None and not isinstance(category, str):
+                errors.append({"line": line_no, "error": "category は文字列で指定してください"})
+                continue
+            rows.append((line_no, name.strip(), (category or "").strip()))
+
+    entries = []
+    for line_no, name, category in rows:
+        category = category or None
+        error = validate(name, category)
+        if error:
+            errors.append({"line": line_no, "error": error})
+        else:
+            entries.append({"name": name, "category": category})
+    errors.sort(key=lambda error: error["line"])
+    if len(entries) > IMPORT_MAX_ITEMS:
+        errors.append({"line": None, "error": f"一度にインポートできるのは {IMPORT_MAX_ITEMS} 件までです"})
+    return entries, errors
+
+
+def export_lines(export_format):
+    """服装リストを CSV または JSON Lines の行として1行ずつ返す"""
+    if export_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(["name", "category"])
+        yield buffer.getvalue()
+        for item in iter_items():
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow([item["name"], item["category"] or ""])
+            yield buffer.getvalue()
+    else:
+        for item in iter_items():
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+
+
+def category_of(item):
+    """服のカテゴリを返す。未登録ならキーワードから推定する"""
+    if item.get("category"):
+        return item["category"]
+    for category, keywords in _CATEGORY_KEYWORDS:
+        if any(keyword in item["name"] for keyword in keywords):
+            return category
+    return "トップス"
+
+
+def _warmth(name):
+    # 長いキーワードを優先する (「Tシャツ」と「シャツ」など)
+    for keyword in sorted(_WARMTH_KEYWORDS, key=len, reverse=True):
+        if keyword in name:
+            return _WARMTH_KEYWORDS[keyword]
+    return 0
+
+
+def _target_warmth(feels_like):
+    """体感温度にちょうど良い暖かさの目安"""
+    if feels_like >= 25:
+        return -2
+    if feels_like >= 20:
+        return -1
+    if feels_like >= 15:
+        return 1
+    if feels_like >= 10:
+        return 2
+    if feels_like >= 5:
+        return 3
+    return 4
+
+
+def score(item, feels_like_values, max_pop):
+    """
+    天気に対する服の適合度 (大きいほど良い)
+
+    Args:
+        item (dict): load_items() の要素
+        feels_like_values (list): 対象期間の体感温度 (℃)
+        max_pop (float): 対象期間の最大降水確率 (0〜1)
+    """
+    warmth = _warmth(item["name"])
+    targets = {_target_warmth(value) for value in feels_like_values} or {0}
+    result = max(-abs(warmth - target) for target in targets)
+
+    is_rain_item = any(keyword in item["name"] for keyword in _RAIN_KEYWORDS)
+    if max_pop >= 0.5 and is_rain_item:
+        result += 3
+    elif max_pop < 0.2 and is_rain_item:
+        result -= 1
+    return result
+
+
+def preselect(items, feels_like_values, max_pop, per_category=None):
+    """
+    天気に合う服をカテゴリごとに上位 per_category 件まで選ぶ (プロンプトの大きさを一定に保つため)
+
+    Returns:
+        list: 選ばれた服の、items 内でのインデックス (元の並び順)
+    """
+    per_category = per_category or CANDIDATES_PER_CATEGORY
+    by_category = {}
+    for index, item in enumerate(items):
+        by_category.setdefault(category_of(item), []).append(index)
+
+    selected = []
+    for indices in by_category.values():
+        # 同じ名前の服は1つだけ候補にする
+        unique = {}
+        for index in indices:
+            unique.setdefault(items[index]["name"], index)
+        ranked = sorted(unique.values(), key=lambda index: score(items[index], feels_like_values, max_pop), reverse=True)
+        selected.extend(ranked[:per_category])
+    return sorted(selected)
+
+
+def format_for_prompt(items, indices):
+    """選ばれた服を「名前 (カテゴリ)」の形式でプロンプト用に並べる"""
+    return "\n".join(f"{items[index]['name']} ({category_of(items[index])})" for index in indices)
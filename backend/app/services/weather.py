@@ -1,30 +1,80 @@
 import requests
+from requests.adapters import HTTPAdapter
 import datetime
 from dotenv import load_dotenv
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
+import services.scheduler as scheduler
+import services.geocode_cache as geocode_cache
+import services.snapshot as snapshot
+import services.forecast_cache as forecast_cache
 
 load_dotenv()
 
-def get_lat_lon(prefecture, city):
+ONECALL_URL = "https://api.openweathermap.org/data/3.0/onecall"
+
+# OpenWeatherとの通信に使うコネクションプール (TLS接続を使い回す)
+_http = requests.Session()
+_http.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=16))
+
+def warm_up():
+    """OpenWeatherへの接続を事前に確立し、コネクションプールに入れておく"""
+    response = _http.head("https://api.openweathermap.org/", timeout=5)
+    return f"HTTP {response.status_code}"
+
+def get_lat_lon(prefecture, city, priority=scheduler.PRIORITY_INTERACTIVE):
     """
     県名と市名を入力すると、緯度と経度を出力する関数
 
     Args:
         prefecture (str): 県名（例: "東京都"）
         city (str): 市名（例: "新宿区"）
+        priority (int): 外部APIスケジューラでの優先度
 
     Returns:
         tuple: (緯度, 経度) のタプル。見つからない場合は None を返す。
+
+    Raises:
+        scheduler.UpstreamBusyError, scheduler.QuotaExceededError: レート制限で実行できず、記録済みの結果もない場合
     """
     address = f"{prefecture}{city}"
+    snapshot_key = geocode_cache.normalize_key(prefecture, city)
+
+    # replayモードでは記録済みのレスポンスだけを使う
+    if snapshot.is_replay():
+        recorded = snapshot.latest("geocode", snapshot_key)
+        if recorded is None or recorded.get("lat") is None:
+            print(f"'{address}' のスナップショットが見つかりませんでした。")
+            return None
+        return (recorded["lat"], recorded["lon"])
+
+    # 永続キャッシュにあればNominatimへは問い合わせない (見つからなかった住所も含む)
+    cached = geocode_cache.get(prefecture, city)
+    if cached is not geocode_cache.MISS:
+        return cached
+
     geolocator = Nominatim(user_agent="weather_app")
+    try:
+        scheduler.acquire("nominatim", priority=priority)
+    except (scheduler.UpstreamBusyError, scheduler.QuotaExceededError):
+        # レート制限・クォータ超過中は記録済みの結果で代替する
+        recorded = snapshot.latest("geocode", snapshot_key)
+        if recorded is None or recorded.get("lat") is None:
+            raise
+        print(f"'{address}' は保存済みの緯度経度で代替します。")
+        return (recorded["lat"], recorded["lon"])
     try:
         location = geolocator.geocode(address, timeout=5)  # タイムアウトを設定
         if location:
-            return (location.latitude, location.longitude)
+            coords = (location.latitude, location.longitude)
+            geocode_cache.put(prefecture, city, coords)
+            snapshot.record("geocode", snapshot_key, {"lat": location.latitude, "lon": location.longitude, "raw": location.raw})
+            return coords
         else:
             print(f"'{address}' の緯度経度が見つかりませんでした。")
+            # タイムアウト等とは違い、確実に存在しない住所なのでキャッシュする
+            geocode_cache.put(prefecture, city, None)
+            snapshot.record("geocode", snapshot_key, {"lat": None, "lon": None, "raw": None})
             return None
     except GeocoderTimedOut:
         print("タイムアウトエラーが発生しました。")
@@ -36,7 +86,7 @@ def get_lat_lon(prefecture, city):
         print(f"エラーが発生しました: {e}")
         return None
 
-def get_weather_forecast_by_coords(lat, lon, api_key):
+def get_weather_forecast_by_coords(lat, lon, api_key, priority=scheduler.PRIORITY_INTERACTIVE):
     """
     指定した緯度・経度の場所の現在時刻以降の3時間ごとの天気予報を取得する
     
@@ -48,17 +98,60 @@ def get_weather_forecast_by_coords(lat, lon, api_key):
         経度
     api_key : str
         OpenWeather APIのAPIキー
+    priority : int
+        外部APIスケジューラでの優先度
     
     Returns:
     --------
     dict
         フォーマット済みの天気予報データ
+
+    Raises:
+    -------
+    scheduler.UpstreamBusyError, scheduler.QuotaExceededError
+        レート制限で実行できず、保存済みの予報もない場合
+    """
+
+    key = snapshot.forecast_key(lat, lon)
+
+    # replayモードでは記録済みのレスポンスだけを使う
+    if snapshot.is_replay():
+        recorded = snapshot.latest("forecast", key)
+        if recorded is None:
+            print(f"({lat}, {lon}) の天気予報のスナップショットが見つかりませんでした。")
+            return None
+        return format_forecast(recorded)
+
+    # 近くの地点で取得済みの予報があれば共有する
+    cached = forecast_cache.lookup(lat, lon)
+    if cached is not None:
+        return cached
+
+    # 同じマスへの同時リクエストは1回の取得にまとめる。
+    # ただし対話的なリクエストは、バックグラウンドの取得のトークン待ちに巻き込まれないよう
+    # 待ち時間を区切り、間に合わなければ自分の優先度でトークンを取って取得する
+    timeout = forecast_cache.FORECAST_FETCH_WAIT_SECONDS if priority == scheduler.PRIORITY_INTERACTIVE else -1
+    lock = forecast_cache.acquire_fetch_lock(lat, lon, timeout=timeout)
+    try:
+        if lock is not None:
+            cached = forecast_cache.lookup(lat, lon)
+            if cached is not None:
+                return cached
+        result = _fetch_forecast(lat, lon, api_key, priority, key)
+        if result is not None:
+            forecast_cache.store(lat, lon, result)
+        return result
+    finally:
+        if lock is not None:
+            lock.release()
+
+def _fetch_forecast(lat, lon, api_key, priority, key):
+    """
+    One Call APIから天気予報を取得する。
+    取得できない場合やレート制限・クォータ超過の場合は、最後に記録した予報で代替する。
     """
-    
-    utc_now = datetime.datetime.utcnow()
-    start_time = utc_now + datetime.timedelta(hours=9)  # UTCから日本時間（+9時間）
     # APIのエンドポイントURL
-    url = "https://api.openweathermap.org/data/3.0/onecall"
+    url = ONECALL_URL
     
     # パラメータの設定
     params = {
@@ -70,49 +163,102 @@ def get_weather_forecast_by_coords(lat, lon, api_key):
         "lang": "ja"  # 日本語で結果を取得
     }
     
-    # APIリクエストを送信
-    response = requests.get(url, params=params)
+    # APIリクエストを送信 (レート制限・クォータを守る)
+    try:
+        scheduler.acquire("openweather", priority=priority)
+    except (scheduler.UpstreamBusyError, scheduler.QuotaExceededError):
+        last_known_good = _last_known_good(lat, lon, key)
+        if last_known_good is None:
+            raise
+        return last_known_good
+    try:
+        response = _http.get(url, params=params, timeout=10)
+    except requests.RequestException as e:
+        print(f"エラー: {e}")
+        response = None
     
     # レスポンスが成功した場合
-    if response.status_code == 200:
+    if response is not None and response.status_code == 200:
         data = response.json()
-            
-        # 必要なデータだけを抽出
-        result = {
-            "forecasts": [],
-            "daily_icon_url": f"https://openweathermap.org/img/wn/{data['daily'][0]['weather'][0]['icon']}@2x.png",
-        }
-        
-        # 3時間ごとの予報データを処理
-        for forecast in data["hourly"]:
-            # UTC時間からJST(+9時間)に変換
-            utc_time = datetime.datetime.utcfromtimestamp(forecast["dt"])
-            forecast_time = utc_time + datetime.timedelta(hours=9)  # UTCから日本時間へ
-
-            # 指定した開始時刻以降のデータのみ処理
-            if forecast_time:
-                # 必要なデータを抽出
-                forecast_data = {
-                    "datetime": forecast_time.strftime("%Y-%m-%d %H:%M:%S"),
-                    "weather": {
-                        "main": forecast["weather"][0]["main"],
-                        "description": forecast["weather"][0]["description"],
-                        "icon": forecast["weather"][0]["icon"]
-                    },
-                    "temperature": forecast["temp"],
-                    "feels_like": forecast["feels_like"],  # 体感温度
-                    "prob_precipitation": forecast["pop"],  # 降水確率
-                    "precipitation": forecast.get("rain", {}).get("1h", 0),  # 1時間あたりの降水量
-                }
-
-                result["forecasts"].append(forecast_data)
-            else:
-                print("データが見つかりませんでした。")
-        
-        return result
-    else:
+        snapshot.record("forecast", key, data)
+        return format_forecast(data)
+
+    if response is not None:
         print(f"エラー: {response.status_code}")
+
+    # OpenWeatherが使えない場合は最後に取得できた予報で代替する
+    return _last_known_good(lat, lon, key)
+
+def _last_known_good(lat, lon, key):
+    """最後に記録した予報をフォーマットして返す。記録がなければ None"""
+    last_known_good = snapshot.latest("forecast", key)
+    if last_known_good is None:
         return None
+    print(f"({lat}, {lon}) は保存済みの天気予報で代替します。")
+    return format_forecast(last_known_good)
+
+def format_forecast(data):
+    """
+    One Call APIの生レスポンスから必要なデータだけを抽出する
+
+    Parameters:
+    -----------
+    data : dict
+        One Call APIのレスポンス
+
+    Returns:
+    --------
+    dict
+        フォーマット済みの天気予報データ
+    """
+    result = {
+        "forecasts": [],
+        "daily_icon": data["daily"][0]["weather"][0]["icon"],  # /static/icons/{code}.png で配信
+    }
+    
+    # 1時間ごとの予報データを処理
+    for forecast in data["hourly"]:
+        # UTC時間からJST(+9時間)に変換
+        utc_time = datetime.datetime.utcfromtimestamp(forecast["dt"])
+        forecast_time = utc_time + datetime.timedelta(hours=9)  # UTCから日本時間へ
+
+        # 必要なデータを抽出
+        forecast_data = {
+            "datetime": forecast_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "weather": {
+                "main": forecast["weather"][0]["main"],
+                "description": forecast["weather"][0]["description"],
+                "icon": forecast["weather"][0]["icon"]
+            },
+            "temperature": forecast["temp"],
+            "feels_like": forecast["feels_like"],  # 体感温度
+            "prob_precipitation": forecast["pop"],  # 降水確率
+            "precipitation": forecast.get("rain", {}).get("1h", 0),  # 1時間あたりの降水量
+        }
+
+        result["forecasts"].append(forecast_data)
+
+    # 日ごとの予報データを処理 (週間の計画用に要点だけ残す)
+    result["daily"] = []
+    for forecast in data.get("daily", []):
+        forecast_date = datetime.datetime.utcfromtimestamp(forecast["dt"]) + datetime.timedelta(hours=9)
+        result["daily"].append({
+            "date": forecast_date.strftime("%Y-%m-%d"),
+            "weather": {
+                "main": forecast["weather"][0]["main"],
+                "description": forecast["weather"][0]["description"],
+                "icon": forecast["weather"][0]["icon"]
+            },
+            "temp_min": forecast["temp"]["min"],
+            "temp_max": forecast["temp"]["max"],
+            "temp_morning": forecast["temp"]["morn"],
+            "temp_evening": forecast["temp"]["eve"],
+            "feels_like": forecast["feels_like"]["day"],  # 日中の体感温度
+            "prob_precipitation": forecast.get("pop", 0),  # 降水確率
+            "precipitation": forecast.get("rain", 0),  # 1日の降水量
+        })
+    
+    return result
 
 if __name__ == "__main__":
     print("This module is not intended to be run directly.")
\ No newline at end of file
@@ -0,0 +1,62 @@
+import os
+import datetime
+import threading
+
+# 計画する日数 (One Call APIの daily は最大8日分)
+WEEKLY_PLAN_DAYS = int(os.getenv("WEEKLY_PLAN_DAYS", "7"))
+
+_WEEKDAYS = ["月", "火", "水", "木", "金", "土", "日"]
+
+_lock = threading.Lock()
+_plans = {}  # (場所, 日付) -> (衣類データのバージョン, 生成済みの週間プラン)
+
+
+def summarize_daily(daily_forecasts, start_date):
+    """
+    日ごとの予報を1日1行に要約する
+
+    Args:
+        daily_forecasts (list): weather.format_forecast の "daily"
+        start_date (datetime.date): この日以降の予報だけを使う
+
+    Returns:
+        str: プロンプトに埋め込む週間天気の要約
+    """
+    lines = []
+    for forecast in daily_forecasts:
+        date = datetime.date.fromisoformat(forecast["date"])
+        if date < start_date:
+            continue
+        if len(lines) >= WEEKLY_PLAN_DAYS:
+            break
+        desc = forecast.get("weather", {}).get("description", "不明")
+        prob_precipitation = round(forecast.get("prob_precipitation", 0) * 100)  # 確率をパーセントに変換
+        lines.append(
+            f"{date.strftime('%m/%d')}({_WEEKDAYS[date.weekday()]}) - {desc}, "
+            f"最低: {forecast['temp_min']}℃, 最高: {forecast['temp_max']}℃, "
+            f"朝: {forecast['temp_morning']}℃, 夕方: {forecast['temp_evening']}℃, "
+            f"体感温度: {forecast['feels_like']}℃，降水確率: {prob_precipitation}%，降水量: {forecast['precipitation']}mm"
+        )
+    return "\n".join(lines)
+
+
+def get_cached(location, date_str, clothes_version):
+    """
+    その日に生成済みの週間プランを返す。衣類データが変わっていれば None を返す。
+
+    Args:
+        clothes_version (str): 衣類データのバージョン (衣類名の一覧のハッシュなど)
+    """
+    with _lock:
+        entry = _plans.get((location, date_str))
+    if entry is None or entry[0] != clothes_version:
+        return None
+    return entry[1]
+
+
+def put(location, date_str, clothes_version, plan):
+    with _lock:
+        # 前日以前のプランは使わないので捨てる
+        for key in [key for key in _plans if key[1] != date_str]:
+            del _plans[key]
+        _plans[(location, date_str)] = (clothes_version, plan)
@@ -1,12 +1,35 @@
 # frontend/app/main.py
 import flet as ft
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
 import time
+import threading
+
+# msgpackがあればバックエンドとの通信をMessagePackで行う (なければJSON)
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 API_BASE_URL = os.getenv("API_BASE_URL", "http://backend:8000")
 FLET_PORT = int(os.getenv("FLET_PORT", 8550))
+API_ACCEPT = "application/x-msgpack, application/json;q=0.9" if msgpack else "application/json"
+# 服装提案の形式 ("structured": 構造化データ / "text": Markdownのテキスト)
+ADVICE_FORMAT = os.getenv("ADVICE_FORMAT", "structured")
+# ブラウザから直接アクセスするアイコン・フォントの配信元 (バックエンドの公開URL)
+ASSET_BASE_URL = os.getenv("ASSET_BASE_URL", "http://localhost:8000")
+
+def weather_icon_src(icon_code):
+    """天気アイコンコードからバックエンドが配信する画像のURLを作成する"""
+    return f"{ASSET_BASE_URL}/static/icons/{icon_code}.png"
+
+def decode_response(response):
+    """レスポンスの Content-Type に応じて MessagePack または JSON をデコードする"""
+    if msgpack and response.headers.get("Content-Type", "").startswith("application/x-msgpack"):
+        return msgpack.unpackb(response.content, raw=False)
+    return response.json()
 
 # テーマカラーを定義
 PRIMARY_COLOR = ft.colors.BLUE_700
@@ -15,26 +38,427 @@ ACCENT_COLOR = ft.colors.AMBER_600
 BACKGROUND_COLOR = ft.colors.WHITE
 TEXT_COLOR = ft.colors.BLUE_GREY_900
 
+# ---- プロセス内の全セッションで共有するリソース ----
+
+# カスタムテーマの設定
+THEME = ft.Theme(
+    color_scheme_seed=PRIMARY_COLOR,
+    visual_density=ft.VisualDensity.COMFORTABLE,
+)
+
+# フォントを設定 (バックエンドから自前で配信)
+FONTS = {
+    "Noto Sans JP": f"{ASSET_BASE_URL}/static/fonts/NotoSansJP-subset.woff2",
+}
+
+# 都道府県と市区町村のデータ
+PREFECTURE_CITY_DATA = {
+    "北海道": ["札幌市", "旭川市", "函館市"],
+    "青森県": ["青森市", "弘前市", "八戸市"],
+    "岩手県": ["盛岡市", "花巻市", "北上市"],
+    "宮城県": ["仙台市", "石巻市", "大崎市"],
+    "秋田県": ["秋田市", "横手市", "大仙市"],
+    "山形県": ["山形市", "鶴岡市", "酒田市"],
+    "福島県": ["福島市", "郡山市", "いわき市"],
+    "茨城県": ["水戸市", "つくば市", "日立市"],
+    "栃木県": ["宇都宮市", "小山市", "足利市"],
+    "群馬県": ["前橋市", "高崎市", "太田市"],
+    "埼玉県": ["さいたま市", "川口市", "川越市"],
+    "千葉県": ["千葉市", "船橋市", "柏市"],
+    "東京都": ["新宿区", "渋谷区", "港区"],
+    "神奈川県": ["横浜市", "川崎市", "相模原市"],
+    "新潟県": ["新潟市", "長岡市", "上越市"],
+    "富山県": ["富山市", "高岡市", "射水市"],
+    "石川県": ["金沢市", "小松市", "白山市"],
+    "福井県": ["福井市", "敦賀市", "坂井市"],
+    "山梨県": ["甲府市", "富士吉田市", "甲斐市"],
+    "長野県": ["長野市", "松本市", "上田市"],
+    "岐阜県": ["岐阜市", "大垣市", "各務原市"],
+    "静岡県": ["静岡市", "浜松市", "沼津市"],
+    "愛知県": ["名古屋市", "豊田市", "岡崎市"],
+    "三重県": ["津市", "四日市市", "鈴鹿市"],
+    "滋賀県": ["大津市", "草津市", "長浜市"],
+    "京都府": ["京都市", "宇治市", "舞鶴市"],
+    "大阪府": ["大阪市", "堺市", "東大阪市"],
+    "兵庫県": ["神戸市", "姫路市", "西宮市"],
+    "奈良県": ["奈良市", "橿原市", "生駒市"],
+    "和歌山県": ["和歌山市", "田辺市", "橋本市"],
+    "鳥取県": ["鳥取市", "米子市", "倉吉市"],
+    "島根県": ["松江市", "出雲市", "浜田市"],
+    "岡山県": ["岡山市", "倉敷市", "津山市"],
+    "広島県": ["広島市", "福山市", "呉市"],
+    "山口県": ["山口市", "下関市", "宇部市"],
+    "徳島県": ["徳島市", "阿南市", "鳴門市"],
+    "香川県": ["高松市", "丸亀市", "三豊市"],
+    "愛媛県": ["松山市", "今治市", "新居浜市"],
+    "高知県": ["高知市", "南国市", "四万十市"],
+    "福岡県": ["福岡市", "北九州市", "久留米市"],
+    "佐賀県": ["佐賀市", "唐津市", "鳥栖市"],
+    "長崎県": ["長崎市", "佐世保市", "諫早市"],
+    "熊本県": ["熊本市", "八代市", "天草市"],
+    "大分県": ["大分市", "別府市", "中津市"],
+    "宮崎県": ["宮崎市", "都城市", "延岡市"],
+    "鹿児島県": ["鹿児島市", "霧島市", "薩摩川内市"],
+    "沖縄県": ["那覇市", "沖縄市", "うるま市"],
+}
+
+# バックエンドとの通信に使うコネクションプール
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=int(os.getenv("HTTP_POOL_MAXSIZE", 64)))
+http_session.mount("http://", http_adapter)
+http_session.mount("https://", http_adapter)
+
+def apply_wardrobe_change(items, change):
+    """服一覧に変更 ("add", 名前) または ("delete", 名前) を適用したリストを返す"""
+    op, name = change
+    items = list(items)
+    if op == "add":
+        items.append(name)
+    elif name in items:
+        items.remove(name)
+    return items
+
+class WardrobeStore:
+    """
+    全セッションで共有する服一覧のスナップショット。
+    変更されると購読している各セッションに通知する。
+    """
+
+    def __init__(self, ttl_seconds):
+        self._ttl_seconds = ttl_seconds
+        self._items = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def get(self, force=False):
+        """服一覧を返す。未取得または古くなっている場合だけバックエンドから取得する"""
+        with self._lock:
+            if force or self._items is None or time.time() - self._fetched_at > self._ttl_seconds:
+                try:
+                    response = http_session.get(
+                        f"{API_BASE_URL}/list",
+                        headers={"Accept": API_ACCEPT},
+                        timeout=10
+                    )
+                    response.raise_for_status()
+                    self._items = decode_response(response)
+                    self._fetched_at = time.time()
+                except Exception as e:
+                    print(f"服のリスト取得エラー: {e}")
+                    # エラー時は手元のリスト(なければ空のリスト)を使う
+                    if self._items is None:
+                        self._items = []
+            return list(self._items)
+
+    def peek(self):
+        """
+        手元のスナップショットを、古くなっていても取得し直さずに返す (未取得の場合だけ取得する)。
+        変更を送った前後の表示更新に使う。確定した変更は apply/set で反映済みなので、
+        そのたびに /list を取得し直す必要はない。
+        """
+        with self._lock:
+            if self._items is not None:
+                return list(self._items)
+        return self.get()
+
+    def set(self, items, source=None):
+        """服一覧を更新し、source 以外の購読セッションに通知する"""
+        with self._lock:
+            self._items = list(items)
+            self._fetched_at = time.time()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(list(items), source)
+            except Exception as e:
+                print(f"服のリスト更新の通知に失敗しました: {e}")
+
+    def apply(self, change, source=None):
+        """
+        確定した変更を手元のスナップショットに反映し、source 以外の購読セッションに通知する。
+        取得時刻は変えないので、ずれがあっても ttl_seconds 後の再取得で解消される。
+        """
+        with self._lock:
+            if self._items is None:
+                return
+            self._items = apply_wardrobe_change(self._items, change)
+            items = list(self._items)
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(list(items), source)
+            except Exception as e:
+                print(f"服のリスト更新の通知に失敗しました: {e}")
+
+    def subscribe(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+wardrobe_store = WardrobeStore(ttl_seconds=float(os.getenv("WARDROBE_CACHE_SECONDS", 30)))
+
+# 最後に表示した服装提案を保存するクライアントストレージのキー
+LAST_ADVICE_KEY = "fashion_checker.last_advice"
+
+def jst_date(timestamp):
+    """UNIX時刻をJSTの日付 (YYYY-MM-DD) にする (服装提案はその日の予報に対するもの)"""
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp + 9 * 3600))
+
+# 服装提案のジョブの結果を待つ最大時間 (秒)
+ADVICE_JOB_TIMEOUT_SECONDS = float(os.getenv("ADVICE_JOB_TIMEOUT_SECONDS", 60))
+
+def request_advice(name, advice_format):
+    """
+    服装提案をジョブとして登録し、結果が出るまで待つ。
+    待つのをやめた場合はジョブをキャンセルする (バックエンドで無駄な生成を続けないため)。
+
+    Returns:
+        dict: /generate と同じ形式のレスポンス
+    """
+    response = http_session.post(
+        f"{API_BASE_URL}/generate/jobs",
+        json={"name": name, "format": advice_format},
+        timeout=10
+    )
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+
+    deadline = time.time() + ADVICE_JOB_TIMEOUT_SECONDS
+    try:
+        while time.time() < deadline:
+            wait = min(15, max(1, deadline - time.time()))
+            response = http_session.get(
+                f"{API_BASE_URL}/jobs/{job_id}",
+                params={"wait": wait},
+                headers={"Accept": API_ACCEPT},
+                timeout=wait + 10
+            )
+            response.raise_for_status()
+            job = decode_response(response)
+            if job["status"] == "done":
+                return job["result"]
+            if job["status"] == "failed":
+                raise RuntimeError(job["error"]["detail"])
+            if job["status"] == "cancelled":
+                raise RuntimeError("服装提案の生成がキャンセルされました")
+        raise TimeoutError("服装提案の生成に時間がかかっています。しばらくしてから再度お試しください")
+    except Exception:
+        try:
+            http_session.delete(f"{API_BASE_URL}/jobs/{job_id}", timeout=5)
+        except Exception as e:
+            print(f"ジョブのキャンセルに失敗しました: {e}")
+        raise
+
+class AdviceEventStream:
+    """
+    バックエンドの /events (Server-Sent Events) を受信し、
+    予報が変わって服装提案が作り直されたときに on_advice(data) を呼ぶ。
+    1セッションにつき1つ作り、表示している場所が変わったら start し直す。
+    """
+
+    RETRY_SECONDS = 5
+
+    def __init__(self, on_advice):
+        self._on_advice = on_advice
+        self._lock = threading.Lock()
+        self._stop = None
+        self._response = None
+
+    def start(self, name, advice_format):
+        self.stop()
+        stop = threading.Event()
+        with self._lock:
+            self._stop = stop
+        threading.Thread(target=self._run, args=(name, advice_format, stop), daemon=True).start()
+
+    def stop(self):
+        with self._lock:
+            stop, response = self._stop, self._response
+            self._stop = self._response = None
+        if stop is not None:
+            stop.set()
+        if response is not None:
+            # 受信待ちで止まっているスレッドを起こす
+            response.close()
+
+    def _run(self, name, advice_format, stop):
+        while not stop.is_set():
+            try:
+                response = http_session.get(
+                    f"{API_BASE_URL}/events",
+                    params={"name": name, "format": advice_format},
+                    headers={"Accept": "text/event-stream"},
+                    stream=True,
+                    timeout=(5, 60)  # 接続までの時間, 受信の間隔 (サーバーは15秒ごとにコメントを送る)
+                )
+                response.raise_for_status()
+                response.encoding = "utf-8"
+                with self._lock:
+                    if self._stop is not stop:
+                        response.close()
+                        return
+                    self._response = response
+                self._read(response, stop)
+            except Exception as e:
+                if not stop.is_set():
+                    print(f"服装提案の更新の受信エラー: {e}")
+            stop.wait(self.RETRY_SECONDS)
+
+    def _read(self, response, stop):
+        event, data_lines = None, []
+        for line in response.iter_lines(decode_unicode=True):
+            if stop.is_set():
+                return
+            if line:
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data_lines.append(line[len("data:"):].strip())
+                continue
+            # 空行でイベントが確定する
+            if event == "advice" and data_lines:
+                try:
+                    self._on_advice(json.loads("\n".join(data_lines)))
+                except Exception as e:
+                    print(f"服装提案の更新の反映に失敗しました: {e}")
+            event, data_lines = None, []
+
+# スタイリッシュなプライマリボタン
+def create_primary_button(text, on_click, width=250, icon=None, ref=None, disabled=False):
+    button = ft.ElevatedButton(
+        text=text,
+        icon=icon,
+        on_click=on_click,
+        style=ft.ButtonStyle(
+            bgcolor=PRIMARY_COLOR if not disabled else ft.colors.GREY_300,
+            color=ft.colors.WHITE if not disabled else ft.colors.GREY_600,
+            padding=16,
+            shape=ft.RoundedRectangleBorder(radius=12),
+            elevation=3,
+            animation_duration=300,
+            shadow_color=ft.colors.with_opacity(0.3, PRIMARY_COLOR),
+        ),
+        width=width,
+        disabled=disabled,
+    )
+    
+    if ref is not None:
+        ref.current = button
+    
+    return button
+
+# スタイリッシュなセカンダリボタン
+def create_secondary_button(text, on_click, width=250, icon=None):
+    return ft.ElevatedButton(
+        text=text,
+        icon=icon,
+        on_click=on_click,
+        style=ft.ButtonStyle(
+            bgcolor=ft.colors.WHITE,
+            color=PRIMARY_COLOR,
+            padding=16,
+            shape=ft.RoundedRectangleBorder(radius=12),
+            side=ft.BorderSide(width=1, color=PRIMARY_COLOR),
+            elevation=0,
+            animation_duration=300,
+        ),
+        width=width,
+    )
+
+# スタイリッシュなカード
+def create_card(content, width=None, height=None, on_click=None):
+    return ft.Container(
+        content=content,
+        width=width,
+        height=height,
+        border_radius=12,
+        bgcolor=ft.colors.WHITE,
+        shadow=ft.BoxShadow(
+            spread_radius=0,
+            blur_radius=10,
+            color=ft.colors.with_opacity(0.1, ft.colors.BLACK),
+            offset=ft.Offset(0, 4),
+        ),
+        animate=ft.animation.Animation(300, ft.AnimationCurve.FAST_OUT_SLOWIN),
+        on_click=on_click,
+        padding=20,
+    )
+
+# 構造化された服装提案をコントロールに変換
+# 形式: {"w": [[時刻, 説明], ...], "u": 雨具の要否, "o": [[活動時間, [ID, ...], 説明], ...], "i": {ID: 衣類名}}
+def create_structured_advice(data: dict) -> list:
+    controls = []
+    if data.get("u"):
+        controls.append(
+            ft.Container(
+                content=ft.Row([
+                    ft.Icon(ft.icons.UMBRELLA, color=PRIMARY_COLOR),
+                    ft.Text("今日は雨具を持っていきましょう", size=16, weight=ft.FontWeight.W_600, color=PRIMARY_COLOR),
+                ]),
+                bgcolor=ft.colors.with_opacity(0.08, PRIMARY_COLOR),
+                padding=10,
+                border_radius=8,
+            )
+        )
+
+    if data.get("w"):
+        controls.append(ft.Text("1時間ごとの天気", size=16, weight=ft.FontWeight.W_600, color=PRIMARY_COLOR))
+        for hour, note in data["w"]:
+            controls.append(
+                ft.Row([
+                    ft.Text(f"{hour}時", size=14, weight=ft.FontWeight.W_500, color=PRIMARY_COLOR, width=48),
+                    ft.Text(note, size=14, color=TEXT_COLOR, expand=True),
+                ], vertical_alignment=ft.CrossAxisAlignment.START)
+            )
+
+    if data.get("o"):
+        controls.append(ft.Text("おすすめの服装", size=16, weight=ft.FontWeight.W_600, color=PRIMARY_COLOR))
+        item_names = data.get("i", {})
+        for slot, item_ids, comment in data["o"]:
+            controls.append(
+                ft.Container(
+                    content=ft.Column([
+                        ft.Text(slot, size=15, weight=ft.FontWeight.W_600, color=TEXT_COLOR),
+                        ft.Row(
+                            [
+                                ft.Chip(
+                                    label=ft.Text(item_names.get(str(item_id), "")),
+                                    leading=ft.Icon(ft.icons.CHECKROOM, color=PRIMARY_COLOR),
+                                )
+                                for item_id in item_ids if str(item_id) in item_names
+                            ],
+                            wrap=True,
+                        ),
+                        ft.Text(comment, size=14, color=TEXT_COLOR, selectable=True),
+                    ], spacing=8),
+                    padding=10,
+                    border_radius=8,
+                    border=ft.border.all(1, ft.colors.with_opacity(0.1, PRIMARY_COLOR)),
+                )
+            )
+    return controls
+
 def main(page: ft.Page):
     page.title = "Fashion Checker"
     page.theme_mode = ft.ThemeMode.LIGHT
     page.padding = 0
     page.bgcolor = BACKGROUND_COLOR
     
-    # カスタムテーマの設定
-    page.theme = ft.Theme(
-        color_scheme_seed=PRIMARY_COLOR,
-        visual_density=ft.VisualDensity.COMFORTABLE,
-    )
-    
-    # フォントを設定
-    page.fonts = {
-        "Noto Sans JP": "https://fonts.googleapis.com/css2?family=Noto+Sans+JP:wght@400;500;700&display=swap",
-    }
+    # カスタムテーマとフォント (全セッションで共有)
+    page.theme = THEME
+    page.fonts = FONTS
     
     # 参照オブジェクト
     cloth_name_field = ft.Ref[ft.TextField]()
+    cloth_category_field = ft.Ref[ft.Dropdown]()
     fashion_button = ft.Ref[ft.ElevatedButton]()
+    advice_container = ft.Ref[ft.Container]()
+    clothes_column = ft.Ref[ft.Column]()
     loading = ft.Ref[ft.ProgressRing]()
     selected_prefecture = ft.Ref[ft.Dropdown]()
     selected_city = ft.Ref[ft.Dropdown]()
@@ -42,55 +466,6 @@ def main(page: ft.Page):
 
     # データ
     fashion_text = ""
-    prefecture_city_data = {
-        "北海道": ["札幌市", "旭川市", "函館市"],
-        "青森県": ["青森市", "弘前市", "八戸市"],
-        "岩手県": ["盛岡市", "花巻市", "北上市"],
-        "宮城県": ["仙台市", "石巻市", "大崎市"],
-        "秋田県": ["秋田市", "横手市", "大仙市"],
-        "山形県": ["山形市", "鶴岡市", "酒田市"],
-        "福島県": ["福島市", "郡山市", "いわき市"],
-        "茨城県": ["水戸市", "つくば市", "日立市"],
-        "栃木県": ["宇都宮市", "小山市", "足利市"],
-        "群馬県": ["前橋市", "高崎市", "太田市"],
-        "埼玉県": ["さいたま市", "川口市", "川越市"],
-        "千葉県": ["千葉市", "船橋市", "柏市"],
-        "東京都": ["新宿区", "渋谷区", "港区"],
-        "神奈川県": ["横浜市", "川崎市", "相模原市"],
-        "新潟県": ["新潟市", "長岡市", "上越市"],
-        "富山県": ["富山市", "高岡市", "射水市"],
-        "石川県": ["金沢市", "小松市", "白山市"],
-        "福井県": ["福井市", "敦賀市", "坂井市"],
-        "山梨県": ["甲府市", "富士吉田市", "甲斐市"],
-        "長野県": ["長野市", "松本市", "上田市"],
-        "岐阜県": ["岐阜市", "大垣市", "各務原市"],
-        "静岡県": ["静岡市", "浜松市", "沼津市"],
-        "愛知県": ["名古屋市", "豊田市", "岡崎市"],
-        "三重県": ["津市", "四日市市", "鈴鹿市"],
-        "滋賀県": ["大津市", "草津市", "長浜市"],
-        "京都府": ["京都市", "宇治市", "舞鶴市"],
-        "大阪府": ["大阪市", "堺市", "東大阪市"],
-        "兵庫県": ["神戸市", "姫路市", "西宮市"],
-        "奈良県": ["奈良市", "橿原市", "生駒市"],
-        "和歌山県": ["和歌山市", "田辺市", "橋本市"],
-        "鳥取県": ["鳥取市", "米子市", "倉吉市"],
-        "島根県": ["松江市", "出雲市", "浜田市"],
-        "岡山県": ["岡山市", "倉敷市", "津山市"],
-        "広島県": ["広島市", "福山市", "呉市"],
-        "山口県": ["山口市", "下関市", "宇部市"],
-        "徳島県": ["徳島市", "阿南市", "鳴門市"],
-        "香川県": ["高松市", "丸亀市", "三豊市"],
-        "愛媛県": ["松山市", "今治市", "新居浜市"],
-        "高知県": ["高知市", "南国市", "四万十市"],
-        "福岡県": ["福岡市", "北九州市", "久留米市"],
-        "佐賀県": ["佐賀市", "唐津市", "鳥栖市"],
-        "長崎県": ["長崎市", "佐世保市", "諫早市"],
-        "熊本県": ["熊本市", "八代市", "天草市"],
-        "大分県": ["大分市", "別府市", "中津市"],
-        "宮崎県": ["宮崎市", "都城市", "延岡市"],
-        "鹿児島県": ["鹿児島市", "霧島市", "薩摩川内市"],
-        "沖縄県": ["那覇市", "沖縄市", "うるま市"],
-    }
 
     if not hasattr(page, "cloth_list"):
         page.cloth_list = []
@@ -144,8 +519,8 @@ def main(page: ft.Page):
     # 都道府県選択時に市区町村を更新
     def update_cities(e):
         prefecture = selected_prefecture.current.value
-        if prefecture and prefecture in prefecture_city_data:
-            cities = prefecture_city_data[prefecture]
+        if prefecture and prefecture in PREFECTURE_CITY_DATA:
+            cities = PREFECTURE_CITY_DATA[prefecture]
             selected_city.current.options = [ft.dropdown.Option(city) for city in cities]
             selected_city.current.value = None
             page.update()
@@ -158,33 +533,19 @@ def main(page: ft.Page):
             show_snackbar("服の名前を入力してください")
             return
 
-        try:
-            # アニメーション効果を追加
-            page.splash = ft.ProgressBar(visible=True, color=PRIMARY_COLOR)
-            page.update()
-            
-            json_data = json.dumps({"name": name})
-            response = requests.post(
-                f"{API_BASE_URL}/register",
-                data = json_data,
-                headers={"Content-Type": "application/json"},
-                timeout = 10
-            )
-            response.raise_for_status()
-            data = response.json()
-            page.cloth_list = data
-            
-            # 完了後にプログレスバーを非表示
-            page.splash.visible = False
-            page.update()
-            
-            show_snackbar(f"'{name}'を登録しました")
-            page.go("/list")
-            
-        except Exception as e:
-            page.splash.visible = False
-            page.update()
-            show_snackbar(f"エラー発生: {e}")
+        # 登録が終わるのを待たずに一覧へ移動し、登録した服を表示しておく
+        change = ("add", name)
+        pending_changes.append(change)
+        page.go("/list")
+
+        # カテゴリは天気に合う服の絞り込みに使われる
+        submit_wardrobe_change(
+            change,
+            "/register",
+            {"name": name, "category": cloth_category_field.current.value},
+            f"'{name}'を登録しました",
+            "登録エラー",
+        )
 
     # スナックバー表示関数
     def show_snackbar(message):
@@ -203,36 +564,13 @@ def main(page: ft.Page):
                 page.dialog.open = False
                 page.update()
                 
-                # 削除処理
-                try:
-                    # ローディングアニメーション
-                    page.splash = ft.ProgressBar(visible=True, color=PRIMARY_COLOR)
-                    page.update()
-                    
-                    json_data = json.dumps({"name": item_name})
-                    response = requests.post(
-                        f"{API_BASE_URL}/delete",
-                        data=json_data,
-                        headers={"Content-Type": "application/json"},
-                        timeout=10
-                    )
-                    response.raise_for_status()
-                    data = response.json()
-                    page.cloth_list = data
-                    
-                    page.splash.visible = False
-                    page.update()
-                    
-                    show_snackbar(f"'{item_name}'を削除しました")
-                    
-                    page.views.pop()
-                    page.route = "/list"
-                    route_change(None)
-                    
-                except Exception as e:
-                    page.splash.visible = False
-                    page.update()
-                    show_snackbar(f"削除エラー: {e}")
+                # 削除が終わるのを待たずに一覧から消しておく
+                change = ("delete", item_name)
+                pending_changes.append(change)
+                page.cloth_list = visible_clothes(wardrobe_store.peek())
+                refresh_clothes_view()
+
+                submit_wardrobe_change(change, "/delete", {"name": item_name}, f"'{item_name}'を削除しました", "削除エラー")
             
             # 確認ダイアログを表示
             page.dialog = ft.AlertDialog(
@@ -251,28 +589,171 @@ def main(page: ft.Page):
         except Exception as e:
             show_snackbar(f"エラー発生: {e}")
 
-    if not hasattr(page, "weather_icon_url"):
-        page.weather_icon_url = ""
+    if not hasattr(page, "weather_icon"):
+        page.weather_icon = ""
+
+    # サーバーの応答を待っている変更 ("add" | "delete", 名前)。表示する一覧にだけ先に反映する
+    pending_changes = []
+
+    def visible_clothes(items):
+        for change in pending_changes:
+            items = apply_wardrobe_change(items, change)
+        return items
 
-    # 服のリストを取得する関数を追加
+    # 服のリストを取得する (全セッションで共有しているスナップショットを使う)
     def fetch_clothes_list():
+        # 送信待ちの変更があるとき (登録直後の画面遷移など) は取得し直さず、手元のスナップショットに
+        # 変更を重ねて表示する。古くなっていても /list の取得で変更の送信を遅らせない
+        items = wardrobe_store.peek() if pending_changes else wardrobe_store.get()
+        page.cloth_list = visible_clothes(items)
+
+    # 服一覧画面を表示中なら、画面全体を作り直さずにリストだけ更新する
+    def refresh_clothes_view():
+        if page.route != "/list":
+            return
+        if clothes_column.current is not None and page.cloth_list:
+            clothes_column.current.controls = [create_clothes_item(item) for item in page.cloth_list]
+            page.update()
+        else:
+            # 空の表示とリストの表示を切り替える場合は作り直す
+            route_change(None)
+
+    def submit_wardrobe_change(change, path, payload, success_message, error_label):
+        """
+        変更をバックエンドに送る。一覧は送信前に更新済みで、失敗した場合は元に戻す。
+        服の数が多くても応答が小さくて済むよう、変更後の一覧は返さないよう求める。
+        """
         try:
-            response = requests.get(
-                f"{API_BASE_URL}/list",  # 新しいエンドポイントを追加する必要があります
+            response = http_session.post(
+                f"{API_BASE_URL}{path}",
+                json=payload,
+                headers={"Prefer": "return=minimal"},
                 timeout=10
             )
             response.raise_for_status()
-            page.cloth_list = response.json()
-            page.update()
+            pending_changes.remove(change)
+            if response.status_code == 204:
+                wardrobe_store.apply(change, source=page)
+            else:
+                wardrobe_store.set(response.json(), source=page)
+            show_snackbar(success_message)
         except Exception as e:
-            print(f"服のリスト取得エラー: {e}")
-            # エラー時は空のリストを設定
-            if not hasattr(page, "cloth_list"):
-                page.cloth_list = []
+            pending_changes.remove(change)
+            show_snackbar(f"{error_label}: {e} (変更を元に戻しました)")
+        page.cloth_list = visible_clothes(wardrobe_store.peek())
+        refresh_clothes_view()
+
+    # 他のセッションで服一覧が変更されたときに表示を更新する
+    def on_wardrobe_change(items, source):
+        page.cloth_list = visible_clothes(items)
+        if source is not page:
+            refresh_clothes_view()
+
+    wardrobe_store.subscribe(on_wardrobe_change)
+
+    # 最後に服装提案を表示した場所 (ホーム画面の選択欄の初期値にもする)
+    last_location = {"prefecture": None, "city": None}
+    # 表示中の服装提案の元になった予報と服一覧 (/generate のレスポンスの basis)
+    advice_basis = None
+
+    # 最後の服装提案をブラウザに保存し、次回の起動時にすぐ表示できるようにする
+    def save_last_advice():
+        try:
+            page.client_storage.set(LAST_ADVICE_KEY, {
+                "prefecture": last_location["prefecture"],
+                "city": last_location["city"],
+                "format": ADVICE_FORMAT,
+                "advice": fashion_text,
+                "icon": page.weather_icon,
+                "basis": advice_basis,
+                "saved_at": time.time(),
+            })
+        except Exception as e:
+            print(f"服装提案の保存に失敗しました: {e}")
+
+    def restore_last_advice():
+        """
+        保存済みの服装提案を読み込む
+
+        Returns:
+            str | None: 保存されていた場所 ("県名_市名")。なければ (または前日以前の提案なら) None
+        """
+        nonlocal fashion_text, advice_basis
+        try:
+            saved = page.client_storage.get(LAST_ADVICE_KEY)
+        except Exception as e:
+            print(f"保存済みの服装提案の読み込みに失敗しました: {e}")
+            return None
+        if not saved or saved.get("format") != ADVICE_FORMAT or \
+                saved.get("city") not in PREFECTURE_CITY_DATA.get(saved.get("prefecture"), []):
+            return None
+        # 前日以前の提案は今日の予報と関係ないので表示しない
+        if jst_date(saved.get("saved_at") or 0) != jst_date(time.time()):
+            try:
+                page.client_storage.remove(LAST_ADVICE_KEY)
+            except Exception as e:
+                print(f"古い服装提案の削除に失敗しました: {e}")
+            return None
+        last_location["prefecture"], last_location["city"] = saved["prefecture"], saved["city"]
+        fashion_text = saved.get("advice") or ""
+        page.weather_icon = saved.get("icon") or ""
+        advice_basis = saved.get("basis")
+        return f"{saved['prefecture']}_{saved['city']}"
+
+    def revalidate_last_advice(name):
+        """
+        保存済みの服装提案を表示したあと、バックグラウンドで最新の提案を取得して差し替える。
+        予報と服一覧が服装に影響するほど変わっていなければ (/generate/check)、生成し直さない。
+        """
+        nonlocal advice_basis
+        if advice_basis is not None:
+            try:
+                response = http_session.post(
+                    f"{API_BASE_URL}/generate/check",
+                    json={"name": name, "format": ADVICE_FORMAT, **advice_basis},
+                    timeout=10
+                )
+                response.raise_for_status()
+                if not response.json()["stale"]:
+                    advice_events.start(name, ADVICE_FORMAT)
+                    return
+            except Exception as e:
+                print(f"服装提案が最新かどうかの確認に失敗しました: {e}")
+        try:
+            data = request_advice(name, ADVICE_FORMAT)
+        except Exception as e:
+            print(f"服装提案の再取得に失敗しました: {e}")
+            return
+        if (data.get("structured") or data.get("generated_text")) != fashion_text or data.get("daily_icon", "") != page.weather_icon:
+            on_advice_update(data, "最新の服装提案に更新しました")
+        else:
+            advice_basis = data.get("basis")
+            save_last_advice()
+        advice_events.start(name, ADVICE_FORMAT)
+
+    # 予報が変わって服装提案が作り直されたら、確認画面をその場で更新する
+    def on_advice_update(data, message="天気予報が変わったため、服装提案を更新しました"):
+        nonlocal fashion_text, advice_basis
+        fashion_text = data.get("structured") or data.get("generated_text", fashion_text)
+        page.weather_icon = data.get("daily_icon", page.weather_icon)
+        advice_basis = data.get("basis")
+        save_last_advice()
+        if page.route == "/confirm" and advice_container.current is not None:
+            advice_container.current.content = create_speech_bubble(fashion_text)
+            page.update()
+            show_snackbar(message)
+
+    advice_events = AdviceEventStream(on_advice_update)
+
+    def on_session_close(e):
+        wardrobe_store.unsubscribe(on_wardrobe_change)
+        advice_events.stop()
+
+    page.on_close = on_session_close
 
     # 服装アドバイス取得
     def fetch_fashion_advice(e=None):
-        nonlocal fashion_text
+        nonlocal fashion_text, advice_basis
 
         if not selected_city.current.value:
             show_snackbar("市区町村を選択してください")
@@ -285,21 +766,22 @@ def main(page: ft.Page):
 
         name = f"{selected_prefecture.current.value}_{selected_city.current.value}"
         try:
-            response = requests.post(
-                f"{API_BASE_URL}/generate",
-                json={"name": name},
-                timeout=20  # 生成AIの応答を待つ時間を長めに
-            )
-            response.raise_for_status()
-            data = response.json()
-            fashion_text = data.get("generated_text", "取得失敗")
-            page.weather_icon_url = data.get("daily_icon_url", "")
+            # 接続を占有しないよう、ジョブとして登録して結果を待つ
+            data = request_advice(name, ADVICE_FORMAT)
+            # 構造化データ(dict)またはMarkdownのテキスト(str)
+            fashion_text = data.get("structured") or data.get("generated_text", "取得失敗")
+            page.weather_icon = data.get("daily_icon", "")
+            advice_basis = data.get("basis")
+            last_location["prefecture"], last_location["city"] = selected_prefecture.current.value, selected_city.current.value
+            save_last_advice()
             # ローディング終了
             loading.current.visible = False
             fashion_button.current.disabled = False
             
             # 成功メッセージ
             show_snackbar(f"{selected_prefecture.current.value}{selected_city.current.value}の服装提案を生成しました")
+            # 以後、この場所の予報が大きく変わったら更新を受け取る
+            advice_events.start(name, ADVICE_FORMAT)
             page.go("/confirm")
             
         except Exception as ex:
@@ -309,119 +791,19 @@ def main(page: ft.Page):
             page.update()
             
             fashion_text = f"エラー発生: {ex}"
-            page.weather_icon_url = ""
+            page.weather_icon = ""
             show_snackbar(f"サーバーとの通信エラー: {ex}")
 
-    # スタイリッシュなプライマリボタン
-    def create_primary_button(text, on_click, width=250, icon=None, ref=None, disabled=False):
-        button = ft.ElevatedButton(
-            text=text,
-            icon=icon,
-            on_click=on_click,
-            style=ft.ButtonStyle(
-                bgcolor=PRIMARY_COLOR if not disabled else ft.colors.GREY_300,
-                color=ft.colors.WHITE if not disabled else ft.colors.GREY_600,
-                padding=16,
-                shape=ft.RoundedRectangleBorder(radius=12),
-                elevation=3,
-                animation_duration=300,
-                shadow_color=ft.colors.with_opacity(0.3, PRIMARY_COLOR),
-            ),
-            width=width,
-            disabled=disabled,
-        )
-        
-        if ref is not None:
-            ref.current = button
-        
-        return button
-
-    # スタイリッシュなセカンダリボタン
-    def create_secondary_button(text, on_click, width=250, icon=None):
-        return ft.ElevatedButton(
-            text=text,
-            icon=icon,
-            on_click=on_click,
-            style=ft.ButtonStyle(
-                bgcolor=ft.colors.WHITE,
-                color=PRIMARY_COLOR,
-                padding=16,
-                shape=ft.RoundedRectangleBorder(radius=12),
-                side=ft.BorderSide(width=1, color=PRIMARY_COLOR),
-                elevation=0,
-                animation_duration=300,
-            ),
-            width=width,
-        )
-
-    # スタイリッシュなカード
-    def create_card(content, width=None, height=None, on_click=None):
-        return ft.Container(
-            content=content,
-            width=width,
-            height=height,
-            border_radius=12,
-            bgcolor=ft.colors.WHITE,
-            shadow=ft.BoxShadow(
-                spread_radius=0,
-                blur_radius=10,
-                color=ft.colors.with_opacity(0.1, ft.colors.BLACK),
-                offset=ft.Offset(0, 4),
-            ),
-            animate=ft.animation.Animation(300, ft.AnimationCurve.FAST_OUT_SLOWIN),
-            on_click=on_click,
-            padding=20,
-        )
-
-    # 共通ビューのレイアウト
-    def common_view(title, controls, show_navbar=True):
-        view_controls = []
-        
-        if show_navbar:
-            view_controls.append(create_navbar())
-        
-        content_controls = [
-            ft.Container(
-                content=ft.Text(
-                    title, 
-                    size=36, 
-                    weight=ft.FontWeight.W_500, 
-                    color=PRIMARY_COLOR,
-                    text_align="center",
-                ),
-                margin=ft.margin.only(top=20, bottom=20),
-            )
-        ] + controls
-        
-        view_controls.append(
-            ft.Container(
-                content=ft.Column(
-                    content_controls,
-                    alignment="center",
-                    horizontal_alignment="center",
-                    spacing=20,
-                ),
-                expand=True,
-                padding=ft.padding.only(left=20, right=20),
-            )
-        )
-        
-        return ft.View(
-            route=page.route,
-            controls=view_controls,
-            vertical_alignment="start",
-            horizontal_alignment="stretch",
-            padding=0,
-        )
-
+    # 構造化された服装提案をコントロールに変換
     # 吹き出し形式のコンテナを生成（スタイリッシュにリデザイン）
-    def create_speech_bubble(content: str) -> ft.Container:
+    # content は Markdownのテキスト、または構造化された服装提案(dict)
+    def create_speech_bubble(content) -> ft.Container:
         weather_section = None
-        if page.weather_icon_url:
+        if page.weather_icon:
             weather_section = ft.Container(
                 content=ft.Row([
                     ft.Image(
-                        src=page.weather_icon_url,
+                        src=weather_icon_src(page.weather_icon),
                         width=64,
                         height=64,
                         fit=ft.ImageFit.CONTAIN,
@@ -443,6 +825,7 @@ def main(page: ft.Page):
                         [
                             ft.Container(
                                 content=ft.Column(
+                                    create_structured_advice(content) if isinstance(content, dict) else
                                     [ft.Markdown(
                                         content,
                                         selectable=True,
@@ -561,8 +944,9 @@ def main(page: ft.Page):
     # ルートハンドリング
     def route_change(route):
         page.views.clear()
+        clothes_column.current = None
 
-        # /list ルートに移動したときにリストを取得
+        # /list ルートに移動したときにリストを取得 (スナップショットが古く、送信待ちの変更がない場合だけ通信する)
         if page.route == "/list":
             fetch_clothes_list()
 
@@ -579,7 +963,8 @@ def main(page: ft.Page):
                                         ref=selected_prefecture,
                                         label="都道府県",
                                         hint_text="選択してください",
-                                        options=[ft.dropdown.Option(pref) for pref in prefecture_city_data.keys()],
+                                        options=[ft.dropdown.Option(pref) for pref in PREFECTURE_CITY_DATA.keys()],
+                                        value=last_location["prefecture"],
                                         on_change=update_cities,
                                         width=180,
                                         filled=True,
@@ -591,7 +976,8 @@ def main(page: ft.Page):
                                         ref=selected_city,
                                         label="市区町村",
                                         hint_text="選択してください",
-                                        options=[],
+                                        options=[ft.dropdown.Option(city) for city in PREFECTURE_CITY_DATA.get(last_location["prefecture"], [])],
+                                        value=last_location["city"],
                                         on_change=update_view_button_state,
                                         width=180,
                                         filled=True,
@@ -609,7 +995,7 @@ def main(page: ft.Page):
                                 "服装提案を見る",
                                 ref=fashion_button,
                                 on_click=fetch_fashion_advice,
-                                disabled=True,
+                                disabled=not last_location["city"],
                                 icon=ft.icons.STYLE,
                                 width=300,
                             ),
@@ -645,7 +1031,7 @@ def main(page: ft.Page):
                 common_view(
                     "あなたにおすすめの服装",
                     [
-                        create_speech_bubble(fashion_text),
+                        ft.Container(ref=advice_container, content=create_speech_bubble(fashion_text)),
                         ft.Container(
                             content=ft.Row(
                                 [
@@ -684,7 +1070,8 @@ def main(page: ft.Page):
             if hasattr(page, "cloth_list") and page.cloth_list:
                 clothes_container = ft.Container(
                     content=ft.Column(
-                        [create_clothes_item(item) for item in page.cloth_list],
+                        ref=clothes_column,
+                        controls=[create_clothes_item(item) for item in page.cloth_list],
                         spacing=5,
                         scroll=ft.ScrollMode.AUTO,
                     ),
@@ -754,6 +1141,7 @@ def main(page: ft.Page):
                                     width=400,
                                 ),
                                 ft.Dropdown(
+                                    ref=cloth_category_field,
                                     label="カテゴリ",
                                     hint_text="選択してください",
                                     options=[
@@ -802,8 +1190,16 @@ def main(page: ft.Page):
 
     page.on_route_change = route_change
     page.on_view_pop = view_pop
-    # 初期データの取得
+    # 初期データの取得 (取得済みのスナップショットがあれば通信しない)
     fetch_clothes_list()
-    page.go(page.route)
+
+    # 前回の服装提案があればすぐに表示し、最新の提案はバックグラウンドで取得する
+    restored_name = restore_last_advice()
+    if restored_name and page.route == "/":
+        page.go("/confirm")
+        show_snackbar("前回の服装提案を表示しています。最新の情報を確認しています…")
+        threading.Thread(target=revalidate_last_advice, args=(restored_name,), daemon=True).start()
+    else:
+        page.go(page.route)
 
 ft.app(target=main, port=FLET_PORT, host="0.0.0.0", view=ft.AppView.WEB_BROWSER)
\ No newline at end of file